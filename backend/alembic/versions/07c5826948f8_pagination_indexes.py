@@ -0,0 +1,77 @@
+"""pagination indexes
+
+Revision ID: 07c5826948f8
+Revises: d5120d314a4c
+Create Date: 2026-10-18 10:40:12.118204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "07c5826948f8"
+down_revision = "d5120d314a4c"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("task") as batch_op:
+        batch_op.add_column(
+            sa.Column("storage_device_id", sa.Integer(), nullable=True)
+        )
+        batch_op.create_foreign_key(
+            "fk_task_storage_device_id_storage_device",
+            "storage_device",
+            ["storage_device_id"],
+            ["id"],
+        )
+    # backfill the device from the task arguments
+    op.execute(
+        """
+        UPDATE task SET storage_device_id = json_extract(args, '$[0]')
+        WHERE func IN (
+            'get_files', 'check_files', 'transfer_files',
+            'transfer_some_files', 'eject_sd'
+        )
+        """
+    )
+    op.execute(
+        """
+        UPDATE task SET storage_device_id = (
+            SELECT file.storage_device_id FROM file
+            WHERE file.id = json_extract(task.args, '$[0]')
+        )
+        WHERE func = 'transfer_file'
+        """
+    )
+    op.create_index("ix_task_status_created", "task", ["status", "created"])
+    op.create_index(
+        "ix_task_storage_device_id_created", "task", ["storage_device_id", "created"]
+    )
+    # rating keys are only unique per storage device
+    op.drop_index("ix_file_rating_key", table_name="file")
+    op.create_index("ix_file_rating_key", "file", ["rating_key"], unique=False)
+    op.create_index(
+        "ix_file_storage_device_id_rating_key",
+        "file",
+        ["storage_device_id", "rating_key"],
+        unique=True,
+    )
+    op.create_index(
+        "ix_file_storage_device_id_status", "file", ["storage_device_id", "status"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_file_storage_device_id_status", table_name="file")
+    op.drop_index("ix_file_storage_device_id_rating_key", table_name="file")
+    op.drop_index("ix_file_rating_key", table_name="file")
+    op.create_index("ix_file_rating_key", "file", ["rating_key"], unique=True)
+    op.drop_index("ix_task_storage_device_id_created", table_name="task")
+    op.drop_index("ix_task_status_created", table_name="task")
+    with op.batch_alter_table("task") as batch_op:
+        batch_op.drop_constraint(
+            "fk_task_storage_device_id_storage_device", type_="foreignkey"
+        )
+        batch_op.drop_column("storage_device_id")
@@ -0,0 +1,25 @@
+"""file rank
+
+Revision ID: 4be0d2f7a913
+Revises: c3e8f1a5b204
+Create Date: 2026-10-18 12:58:10.447129
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4be0d2f7a913"
+down_revision = "c3e8f1a5b204"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("rank", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("rank")
@@ -0,0 +1,32 @@
+"""device tuning
+
+Revision ID: 7d2c5e9f1b46
+Revises: e6a9b3c1d582
+Create Date: 2026-10-18 15:02:41.518304
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7d2c5e9f1b46"
+down_revision = "e6a9b3c1d582"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.add_column(sa.Column("write_throughput", sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column("chunk_size", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("max_transfers", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("benchmarked_at", sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.drop_column("benchmarked_at")
+        batch_op.drop_column("max_transfers")
+        batch_op.drop_column("chunk_size")
+        batch_op.drop_column("write_throughput")
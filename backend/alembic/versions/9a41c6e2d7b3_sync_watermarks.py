@@ -0,0 +1,37 @@
+"""sync watermarks
+
+Revision ID: 9a41c6e2d7b3
+Revises: f73a7c8b3116
+Create Date: 2026-10-18 11:48:05.312877
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9a41c6e2d7b3"
+down_revision = "f73a7c8b3116"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.add_column(sa.Column("last_full_sync", sa.DateTime(), nullable=True))
+        batch_op.add_column(
+            sa.Column("playlist_updated_at", sa.DateTime(), nullable=True)
+        )
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("updated_at", sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column("last_viewed_at", sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column("source_mtime", sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("source_mtime")
+        batch_op.drop_column("last_viewed_at")
+        batch_op.drop_column("updated_at")
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.drop_column("playlist_updated_at")
+        batch_op.drop_column("last_full_sync")
@@ -0,0 +1,25 @@
+"""file checksum
+
+Revision ID: c3e8f1a5b204
+Revises: 9a41c6e2d7b3
+Create Date: 2026-10-18 12:21:44.906318
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c3e8f1a5b204"
+down_revision = "9a41c6e2d7b3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.add_column(sa.Column("checksum", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("file") as batch_op:
+        batch_op.drop_column("checksum")
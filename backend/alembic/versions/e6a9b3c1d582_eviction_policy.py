@@ -0,0 +1,25 @@
+"""eviction policy
+
+Revision ID: e6a9b3c1d582
+Revises: 4be0d2f7a913
+Create Date: 2026-10-18 13:34:27.250913
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e6a9b3c1d582"
+down_revision = "4be0d2f7a913"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.add_column(sa.Column("eviction_policy", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("storage_device") as batch_op:
+        batch_op.drop_column("eviction_policy")
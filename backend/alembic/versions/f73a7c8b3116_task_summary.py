@@ -0,0 +1,46 @@
+"""task summary
+
+Revision ID: f73a7c8b3116
+Revises: 07c5826948f8
+Create Date: 2026-10-18 11:02:37.540981
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f73a7c8b3116"
+down_revision = "07c5826948f8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "task_summary",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("func", sa.String(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum(
+                "PENDING", "RUNNING", "SUCCESS", "FAILED", "STOPPED", name="taskstatus"
+            ),
+            nullable=False,
+        ),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("bytes", sa.Float(), nullable=False),
+        sa.Column("duration", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_task_summary_day_func_status",
+        "task_summary",
+        ["day", "func", "status"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_task_summary_day_func_status", table_name="task_summary")
+    op.drop_table("task_summary")
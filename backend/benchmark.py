@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+from time import monotonic
+
+from transfer import advise
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+MB = 1024 * 1024
+
+# bytes written by each probe of benchmark_device
+BENCHMARK_SIZE = int(os.environ.get("BENCHMARK_SIZE", 32 * MB))
+BENCHMARK_CHUNK_SIZES = (1 * MB, 4 * MB, 16 * MB)
+BENCHMARK_PREFIX = ".gatosnap-benchmark"
+MIN_CHUNK_SIZE = 1 * MB
+MAX_CHUNK_SIZE = 64 * MB
+# most transfers the tuning will run at once on a device
+MAX_TUNED_TRANSFERS = int(os.environ.get("MAX_TUNED_TRANSFERS", 4))
+# a chunk takes about this many seconds to copy at the device's throughput,
+# big enough to keep the syscall overhead down and small enough for progress,
+# throttling and stopping to stay responsive
+CHUNK_SECONDS = 0.5
+# weight of a new observation in the throughput moving averages
+SMOOTHING = 0.3
+# how much more throughput another parallel transfer has to bring to be kept
+PARALLEL_GAIN = 1.15
+
+
+def write_probe(path, size, chunk_size):
+    """Write size bytes to path sequentially, return the seconds it took."""
+    data = os.urandom(chunk_size)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        started = monotonic()
+        written = 0
+        while written < size:
+            written += os.write(fd, data[: size - written])
+        os.fsync(fd)
+        elapsed = monotonic() - started
+        advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
+    return max(elapsed, 1e-6)
+
+
+def parallel_probe(base_path, size, chunk_size, count):
+    """Write size bytes split over count files at once, return bytes/second."""
+    errors = []
+
+    def run(index):
+        try:
+            write_probe(
+                os.path.join(base_path, "{}-{}".format(BENCHMARK_PREFIX, index)),
+                size // count,
+                chunk_size,
+            )
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    started = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return size // count * count / max(monotonic() - started, 1e-6)
+
+
+def get_chunk_size(throughput):
+    """The power of two chunk size closest to CHUNK_SECONDS of copying."""
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size * 2 <= min(throughput * CHUNK_SECONDS, MAX_CHUNK_SIZE):
+        chunk_size *= 2
+    return chunk_size
+
+
+def benchmark_device(base_path, size=BENCHMARK_SIZE):
+    """Probe a storage device with sequential writes of a scratch file.
+
+    Each of BENCHMARK_CHUNK_SIZES writes size bytes and the fastest is kept,
+    then the same amount is split over 2, 4, ... files written at once for
+    as long as that brings PARALLEL_GAIN more throughput. Returns a dict of
+    the StorageDevice columns write_throughput, chunk_size and max_transfers,
+    and a dict of the throughput measured at each number of transfers for
+    DeviceTuner.seed.
+    """
+    results = {}
+    path = os.path.join(base_path, BENCHMARK_PREFIX)
+    try:
+        for chunk_size in BENCHMARK_CHUNK_SIZES:
+            results[chunk_size] = size / write_probe(path, size, chunk_size)
+        # the smallest chunk size within 5% of the fastest
+        fastest = max(results.values())
+        chunk_size = min(c for c, t in results.items() if t >= fastest * 0.95)
+        throughput = results[chunk_size]
+        levels = {1: throughput}
+        max_transfers = 1
+        while max_transfers * 2 <= MAX_TUNED_TRANSFERS:
+            parallel = parallel_probe(base_path, size, chunk_size, max_transfers * 2)
+            levels[max_transfers * 2] = parallel
+            if parallel < throughput * PARALLEL_GAIN:
+                break
+            max_transfers *= 2
+            throughput = parallel
+    finally:
+        for name in os.listdir(base_path):
+            if name.startswith(BENCHMARK_PREFIX):
+                os.remove(os.path.join(base_path, name))
+    logger.info(
+        "Benchmarked {}: {:0.1f}MB/s, {}MB chunks, {} transfers ({})".format(
+            base_path,
+            throughput / MB,
+            chunk_size // MB,
+            max_transfers,
+            ", ".join(
+                "{}MB {:0.1f}MB/s".format(c // MB, t / MB) for c, t in results.items()
+            ),
+        )
+    )
+    changes = {
+        "write_throughput": throughput,
+        "chunk_size": max(chunk_size, get_chunk_size(throughput)),
+        "max_transfers": max_transfers,
+    }
+    return changes, levels
+
+
+class DeviceTuner:
+    """Keep adjusting each storage device's settings from its transfers.
+
+    Every finished transfer reports how fast it copied and how many
+    transfers were running on the device on average while it did. The
+    device's throughput is a moving average of the total at each level of
+    concurrency, starting from the benchmark's, chunk sizes follow it with
+    get_chunk_size and max_transfers climbs while another transfer adds
+    PARALLEL_GAIN throughput and drops back when it doesn't. It only climbs
+    past levels transfers have measured, not ones the benchmark found slower.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # storage device id -> {level of concurrency: bytes/second}
+        self.levels = {}
+        # storage device id -> levels measured by transfers
+        self.measured = {}
+
+    def seed(self, sd_id, levels):
+        """Start sd_id's levels over from benchmark_device's."""
+        with self.lock:
+            self.levels[sd_id] = dict(levels)
+            self.measured[sd_id] = set()
+
+    def observe(self, sd, copied, seconds, concurrent):
+        """Record a transfer to sd and return the changed columns to save.
+
+        concurrent is the average number of transfers running on sd while
+        this one did. Transfers of less than BENCHMARK_SIZE are too short to
+        measure.
+        """
+        if copied < BENCHMARK_SIZE or seconds <= 0:
+            return {}
+        concurrent = max(concurrent, 1)
+        total = copied / seconds * concurrent
+        level = round(concurrent)
+        current = sd.max_transfers or 1
+        with self.lock:
+            levels = self.levels.get(sd.id)
+            if levels is None:
+                # not benchmarked since startup, start from the saved result
+                levels = self.levels[sd.id] = {}
+                if sd.write_throughput:
+                    levels[current] = sd.write_throughput
+            measured = self.measured.setdefault(sd.id, set())
+            current_measured = current in measured
+            previous = levels.get(level)
+            levels[level] = (
+                total if previous is None else previous + (total - previous) * SMOOTHING
+            )
+            measured.add(level)
+            below = levels.get(current - 1)
+            above = levels.get(current + 1)
+            throughput = levels.get(current)
+            if throughput is None:
+                throughput = levels[concurrent]
+            elif below is not None and throughput < below * PARALLEL_GAIN:
+                current -= 1
+                throughput = below
+            elif above is not None:
+                if above >= throughput * PARALLEL_GAIN:
+                    current += 1
+                    throughput = above
+            elif current_measured and level == current < MAX_TUNED_TRANSFERS:
+                # the device is running all it's allowed to, see if one more helps
+                current += 1
+        changes = {
+            "write_throughput": throughput,
+            "chunk_size": get_chunk_size(throughput),
+            "max_transfers": current,
+        }
+        return {
+            key: value
+            for key, value in changes.items()
+            if key == "write_throughput" or getattr(sd, key) != value
+        }
+
+
+device_tuner = DeviceTuner()
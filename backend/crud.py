@@ -1,21 +1,129 @@
+import base64
+import json
+from datetime import date, datetime
+
 import models
 import schemas
+import sqlalchemy as sa
+from events import publish_created, task_events
+from eviction import get_policies, plan_eviction
+from planner import DEVICE_RESERVE, plan_transfers
 from plex_api import get_account, get_client, save_auth_token, save_base_url
+from progress import progress_registry
+from scheduler import PRIORITY_USER
 from sqlalchemy.orm import Session
-from tasks import add_task_to_queue
+from tasks import add_task_to_queue, get_queue_metrics, get_task_storage_device_id
+from throttle import bandwidth_limiter
+
+TASK_SORTS = {"id": models.Task.id, "created": models.Task.created}
+FILE_SORTS = {"id": models.File.id, "title": models.File.title}
+
+
+class InvalidCursor(Exception):
+    pass
+
 
+class DeviceNotConnected(Exception):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor {}".format(cursor))
+    return value, last_id
 
-def get_tasks(db: Session, skip: int = 0, limit: int = 100):
-    # return db.query(models.Task).offset(skip).limit(limit).all()
-    return db.query(models.Task).all()
+
+def keyset_page(query, sorts, id_column, sort, cursor, limit):
+    """Return a page of query ordered by sort and the cursor for the next page.
+
+    Pages are found by comparing (sort column, id) with the last row of the
+    previous page instead of using OFFSET, so every page is an index seek.
+    """
+    descending = sort.startswith("-")
+    column = sorts[sort.lstrip("-")]
+    if isinstance(column.type, sa.DateTime):
+        # compare the text sqlite stored, now() and python datetimes are
+        # stored in different formats
+        column = sa.type_coerce(column, sa.String)
+    query = query.add_columns(column.label("cursor_value"))
+    if cursor is not None:
+        value, last_id = decode_cursor(cursor)
+        key = sa.tuple_(column, id_column)
+        bound = sa.tuple_(sa.literal(value, column.type), sa.literal(last_id))
+        query = query.filter(key < bound if descending else key > bound)
+    if descending:
+        query = query.order_by(column.desc(), id_column.desc())
+    else:
+        query = query.order_by(column.asc(), id_column.asc())
+    rows = query.limit(limit + 1).all()
+    items = [row[0] for row in rows[:limit]]
+    if len(rows) <= limit:
+        return items, None
+    return items, encode_cursor([rows[limit - 1].cursor_value, items[-1].id])
+
+
+def with_live_progress(task: models.Task):
+    # running tasks only write their progress to the database now and then
+    task = schemas.Task.model_validate(task)
+    live = progress_registry.get(task.id)
+    if live is None:
+        return task
+    return task.model_copy(update=live)
+
+
+def get_tasks(
+    db: Session,
+    cursor: str | None = None,
+    limit: int = 100,
+    sort: str = "-id",
+    status: list[schemas.TaskStatus] | None = None,
+    storage_device_id: int | None = None,
+    func: list[str] | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+):
+    query = db.query(models.Task)
+    if status:
+        query = query.filter(models.Task.status.in_(status))
+    if storage_device_id is not None:
+        query = query.filter(models.Task.storage_device_id == storage_device_id)
+    if func:
+        query = query.filter(models.Task.func.in_(func))
+    if created_after is not None:
+        query = query.filter(models.Task.created >= created_after)
+    if created_before is not None:
+        query = query.filter(models.Task.created < created_before)
+    tasks, next_cursor = keyset_page(
+        query, TASK_SORTS, models.Task.id, sort, cursor, limit
+    )
+    return [with_live_progress(task) for task in tasks], next_cursor
+
+
+def get_task_summaries(db: Session, start: date | None = None, end: date | None = None):
+    query = db.query(models.TaskSummary)
+    if start is not None:
+        query = query.filter(models.TaskSummary.day >= start)
+    if end is not None:
+        query = query.filter(models.TaskSummary.day <= end)
+    return query.order_by(models.TaskSummary.day, models.TaskSummary.func).all()
 
 
 def create_task(db: Session, task):
     db_task = models.Task(**task.dict())
+    db_task.storage_device_id = get_task_storage_device_id(
+        db, db_task.func, db_task.args
+    )
     db.add(db_task)
     db.commit()
     db.refresh(db_task)
-    add_task_to_queue(db_task.id)
+    publish_created(db_task)
+    add_task_to_queue(db_task.id, PRIORITY_USER)
     db.refresh(db_task)
     return db_task
 
@@ -24,6 +132,7 @@ def delete_task(db: Session, task_id: int):
     db_task = db.query(models.Task).filter(models.Task.id == task_id).first()
     db.delete(db_task)
     db.commit()
+    task_events.publish(task_id, "deleted", {})
     return True
 
 
@@ -32,9 +141,16 @@ def update_task(db: Session, task_id: int, task: schemas.TaskUpdate):
     db_task.status = task.status
     db.commit()
     db.refresh(db_task)
+    if db_task.status == schemas.TaskStatus.STOPPED:
+        progress_registry.stop(db_task.id)
+    task_events.publish(db_task.id, "status", {"status": db_task.status})
     if db_task.status == schemas.TaskStatus.PENDING:
-        add_task_to_queue(db_task.id)
-    return db_task
+        add_task_to_queue(db_task.id, PRIORITY_USER)
+    return with_live_progress(db_task)
+
+
+def get_task_metrics():
+    return get_queue_metrics()
 
 
 def get_storage_devices(db: Session, skip: int = 0, limit: int = 100):
@@ -46,15 +162,91 @@ def create_storage_device(db: Session, storage_device):
     db.add(db_storage_device)
     db.commit()
     db.refresh(db_storage_device)
+    # picks the device's chunk size and transfers at once, transfer_files
+    # benchmarks it instead if it isn't connected yet
+    task = models.Task(
+        name="Benchmark {}".format(db_storage_device.name),
+        func="benchmark_sd",
+        args=[db_storage_device.id],
+        kwargs={},
+        storage_device_id=db_storage_device.id,
+    )
+    db.add(task)
+    db.commit()
+    publish_created(task)
+    add_task_to_queue(task.id, PRIORITY_USER)
+    db.refresh(db_storage_device)
+    return db_storage_device
+
+
+def update_storage_device(
+    db: Session, device_id: int, storage_device: schemas.StorageDeviceUpdate
+):
+    db_storage_device = db.get(models.StorageDevice, device_id)
+    if db_storage_device is None:
+        return None
+    changes = storage_device.model_dump(exclude_unset=True)
+    if "eviction_policy" in changes:
+        # raises ValueError for an unknown policy
+        changes["eviction_policy"] = (
+            ",".join(get_policies(changes["eviction_policy"])) or None
+        )
+    for key, value in changes.items():
+        if value is None and not models.StorageDevice.__table__.c[key].nullable:
+            raise ValueError("{} can't be empty".format(key))
+        setattr(db_storage_device, key, value)
+    db.commit()
+    db.refresh(db_storage_device)
     return db_storage_device
 
 
 def get_files_for_storage_device(
-    db: Session, device_id: int, skip: int = 0, limit: int = 100
+    db: Session,
+    device_id: int,
+    cursor: str | None = None,
+    limit: int = 100,
+    sort: str = "id",
+    status: list[schemas.FileStatus] | None = None,
 ):
-    return (
-        db.query(models.File).filter(models.File.storage_device_id == device_id).all()
-    )
+    query = db.query(models.File).filter(models.File.storage_device_id == device_id)
+    if status:
+        query = query.filter(models.File.status.in_(status))
+    return keyset_page(query, FILE_SORTS, models.File.id, sort, cursor, limit)
+
+
+def get_transfer_plan(
+    db: Session,
+    device_id: int,
+    file_ids: list[int] | None = None,
+    reserve: int = DEVICE_RESERVE,
+):
+    storage_device = db.get(models.StorageDevice, device_id)
+    if storage_device is None:
+        return None
+    if not storage_device.connected:
+        raise DeviceNotConnected("{} isn't connected".format(storage_device.name))
+    return plan_transfers(db, storage_device, file_ids, reserve)
+
+
+def get_eviction_plan(
+    db: Session,
+    device_id: int,
+    policies: list[str] | None = None,
+    reserve: int = DEVICE_RESERVE,
+):
+    plan = get_transfer_plan(db, device_id, reserve=reserve)
+    if plan is None:
+        return None
+    storage_device = db.get(models.StorageDevice, device_id)
+    return {"plan": plan, "eviction": plan_eviction(db, storage_device, plan, policies)}
+
+
+def get_bandwidth_limits():
+    return bandwidth_limiter.get_config()
+
+
+def update_bandwidth_limits(limits: schemas.BandwidthLimits):
+    return bandwidth_limiter.set_config(limits.model_dump())
 
 
 def get_files(db: Session, skip: int = 0, limit: int = 100):
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from fastapi.encoders import jsonable_encoder
+
+# how many times a second each stream sends the changes since its last send
+TASK_EVENTS_MAX_RATE = float(os.environ.get("TASK_EVENTS_MAX_RATE", 2))
+# number of changed tasks remembered for clients resuming from a cursor
+TASK_EVENTS_BACKLOG = int(os.environ.get("TASK_EVENTS_BACKLOG", 10000))
+KEEPALIVE_INTERVAL = 15
+
+
+class TaskEvents:
+    """The latest change to each task, ordered by a global sequence number.
+
+    Changes to the same task are merged, so a client reading everything since
+    its cursor gets one event per task with its current state: "created" if
+    the task was created after the cursor, "deleted" if it has since been
+    deleted, "status" if its status changed and "progress" otherwise.
+
+    Sequence numbers start over with each process, so event ids are prefixed
+    with an epoch unique to the process and a cursor from another epoch is
+    reset.
+    """
+
+    def __init__(self, backlog=TASK_EVENTS_BACKLOG):
+        self.backlog = backlog
+        self.lock = threading.Lock()
+        self.epoch = uuid4().hex[:8]
+        self.seq = 0
+        self.pruned_seq = 0
+        self.tasks = OrderedDict()
+
+    def publish(self, task_id, kind, data):
+        with self.lock:
+            self.seq += 1
+            entry = self.tasks.pop(task_id, None) or {
+                "data": {"id": task_id},
+                "created_seq": 0,
+                "status_seq": 0,
+                "deleted": False,
+            }
+            entry["data"].update(data)
+            entry["seq"] = self.seq
+            if kind == "created":
+                entry["created_seq"] = self.seq
+            elif kind == "status":
+                entry["status_seq"] = self.seq
+            elif kind == "deleted":
+                entry["deleted"] = True
+            self.tasks[task_id] = entry
+            while len(self.tasks) > self.backlog:
+                _, pruned = self.tasks.popitem(last=False)
+                self.pruned_seq = pruned["seq"]
+
+    def reset(self):
+        """Forget every change, for bulk updates that aren't published one
+        task at a time, so every client reloads its tasks."""
+        with self.lock:
+            self.seq += 1
+            self.pruned_seq = self.seq
+            self.tasks.clear()
+
+    def event_id(self, seq):
+        return "{}-{}".format(self.epoch, seq)
+
+    def parse_event_id(self, event_id):
+        """Return the sequence number in event_id, or -1 if it's from another
+        process or not an event id at all so the client is reset."""
+        epoch, _, seq = event_id.rpartition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return -1
+        return int(seq)
+
+    def since(self, cursor):
+        """Return (events, cursor) for everything after cursor.
+
+        events is None when changes after cursor have already been pruned, or
+        cursor isn't one this process gave out, and the client has to reload
+        its tasks.
+        """
+        with self.lock:
+            if cursor is None:
+                return [], self.seq
+            if cursor < self.pruned_seq or cursor > self.seq:
+                return None, self.seq
+            events = []
+            for entry in reversed(self.tasks.values()):
+                if entry["seq"] <= cursor:
+                    break
+                if entry["deleted"]:
+                    kind = "deleted"
+                elif entry["created_seq"] > cursor:
+                    kind = "created"
+                elif entry["status_seq"] > cursor:
+                    kind = "status"
+                else:
+                    kind = "progress"
+                events.append((entry["seq"], kind, dict(entry["data"])))
+            return events[::-1], self.seq
+
+
+task_events = TaskEvents()
+
+
+def publish_created(task):
+    task_events.publish(
+        task.id,
+        "created",
+        {column.name: getattr(task, column.name) for column in task.__table__.columns},
+    )
+
+
+def format_event(seq, kind, data):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        task_events.event_id(seq), kind, json.dumps(jsonable_encoder(data))
+    )
+
+
+async def stream_task_events(request, event_id=None):
+    """Stream task changes after the event event_id as Server-Sent Events."""
+    interval = 1 / TASK_EVENTS_MAX_RATE
+    idle = 0
+    if event_id is None:
+        _, cursor = task_events.since(None)
+    else:
+        cursor = task_events.parse_event_id(event_id)
+    yield "retry: 1000\nid: {}\n\n".format(task_events.event_id(max(cursor, 0)))
+    while not await request.is_disconnected():
+        events, cursor = task_events.since(cursor)
+        if events is None:
+            yield format_event(cursor, "reset", {})
+            idle = 0
+        elif events:
+            for event in events:
+                yield format_event(*event)
+            idle = 0
+        elif idle >= KEEPALIVE_INTERVAL:
+            yield ": keepalive\n\n"
+            idle = 0
+        await asyncio.sleep(interval)
+        idle += interval
@@ -0,0 +1,178 @@
+import logging
+from datetime import datetime
+
+import sqlalchemy as sa
+from manifest import manifest_cache
+from models import File, FileStatus
+from planner import RANK_PLAYLIST
+from plex_api import get_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+
+def get_rank_order(file):
+    # worst ranked first, files without a rank are the worst
+    return (file.rank is not None, -(file.rank or 0))
+
+
+def lru(sd, files):
+    """Least recently viewed first, never viewed counts as oldest."""
+    return sorted(
+        files,
+        key=lambda file: file.last_viewed_at or datetime.min,
+    )
+
+
+def watched(sd, files):
+    """Files already marked watched, then ones that have been started."""
+    return sorted(
+        [
+            file
+            for file in files
+            if file.status == FileStatus.WATCHED or file.last_viewed_at is not None
+        ],
+        key=lambda file: (
+            file.status != FileStatus.WATCHED,
+            file.last_viewed_at or datetime.min,
+        ),
+    )
+
+
+def furthest(sd, files):
+    """Episodes furthest from their show's next up, by rank."""
+    return sorted(files, key=get_rank_order)
+
+
+def playlist_removed(sd, files):
+    """Files that were synced from the playlist and have since left it."""
+    if not sd.sync_playlist:
+        return []
+    in_playlist = {
+        item.ratingKey for item in get_client().playlist(sd.sync_playlist).items()
+    }
+    return [
+        file
+        for file in files
+        if file.rank == RANK_PLAYLIST and file.rating_key not in in_playlist
+    ]
+
+
+EVICTION_POLICIES = {
+    "lru": lru,
+    "watched": watched,
+    "furthest": furthest,
+    "playlist_removed": playlist_removed,
+}
+
+
+def get_policies(value):
+    """Parse a list or comma separated string of policy names."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    policies = [name.strip() for name in value if name.strip()]
+    for name in policies:
+        if name not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}".format(name))
+    return policies
+
+
+def is_worse(file, entry):
+    # only files ranked below the one that needs the space are given up for it
+    return (file.rank is None, file.rank or 0) > (
+        entry["rank"] is None,
+        entry["rank"] or 0,
+    )
+
+
+def plan_eviction(session, sd, plan, policies=None):
+    """Choose the files to delete so deferred files in a transfer plan fit.
+
+    The policies are applied in turn, each one adding the files it would
+    evict, in order, after those of the previous ones. Deferred files are
+    considered in rank order and each is only admitted when enough lower
+    ranked files can be evicted to fit it, so no more is freed than the
+    admitted files need. Nothing is deleted, see tasks.apply_eviction.
+    """
+    policies = get_policies(sd.eviction_policy if policies is None else policies)
+    eviction = {
+        "policies": policies,
+        "bytes_freed": 0,
+        "evicted": [],
+        "admitted": [],
+    }
+    if not policies or not plan["deferred"]:
+        return eviction
+    manifest = manifest_cache.get(sd)
+    planned = {entry["id"] for entry in plan["admitted"] + plan["deferred"]}
+    files = [
+        file
+        for file in session.execute(
+            sa.select(
+                File.id,
+                File.title,
+                File.remote_path,
+                File.rating_key,
+                File.file_size,
+                File.status,
+                File.rank,
+                File.last_viewed_at,
+            ).where(
+                File.storage_device_id == sd.id,
+                File.status.in_([FileStatus.SYNCED, FileStatus.WATCHED]),
+            )
+        )
+        if file.id not in planned
+        and manifest.exists(sd.get_drive_path(file.remote_path))
+    ]
+    candidates = []
+    seen = set()
+    for name in policies:
+        for file in EVICTION_POLICIES[name](sd, files):
+            if file.id not in seen:
+                seen.add(file.id)
+                candidates.append(file)
+    spare = plan["free"] - plan["reserve"] - plan["queued"] - plan["bytes_in"]
+    for entry in plan["deferred"]:
+        chosen = []
+        freed = 0
+        for file in candidates:
+            if spare + freed >= entry["bytes"]:
+                break
+            if is_worse(file, entry):
+                chosen.append(file)
+                freed += file.file_size
+        if spare + freed < entry["bytes"]:
+            continue
+        spare += freed - entry["bytes"]
+        for file in chosen:
+            candidates.remove(file)
+            eviction["evicted"].append(
+                {
+                    "id": file.id,
+                    "title": file.title,
+                    "remote_path": file.remote_path,
+                    "file_size": file.file_size,
+                    "rank": file.rank,
+                    "status": file.status,
+                    "bytes": file.file_size,
+                }
+            )
+        eviction["bytes_freed"] += freed
+        eviction["admitted"].append(entry)
+    logger.info(
+        "Evicting {} files ({} bytes) from {} to fit {} more".format(
+            len(eviction["evicted"]),
+            eviction["bytes_freed"],
+            sd.name,
+            len(eviction["admitted"]),
+        )
+    )
+    return eviction
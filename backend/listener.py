@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import threading
+from time import monotonic
+
+import database
+import sqlalchemy as sa
+from events import publish_created
+from models import File, StorageDevice, Task
+from plex_api import get_client
+from plexapi.alert import AlertListener
+from scheduler import PRIORITY_SCHEDULED
+from tasks import add_task_to_queue
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+PLEX_LISTENER = os.environ.get("PLEX_LISTENER", "1") == "1"
+# websocket to read notifications from instead of the Plex server's own
+PLEX_NOTIFICATIONS_URL = os.environ.get("PLEX_NOTIFICATIONS_URL")
+# changes are queued once no notification has come in for LISTENER_DEBOUNCE
+# seconds, and at the latest LISTENER_MAX_DELAY seconds after the first one
+LISTENER_DEBOUNCE = float(os.environ.get("LISTENER_DEBOUNCE", 5))
+LISTENER_MAX_DELAY = float(os.environ.get("LISTENER_MAX_DELAY", 60))
+# seconds between reconnects, doubled after every failed attempt
+LISTENER_BACKOFF_MIN = float(os.environ.get("LISTENER_BACKOFF_MIN", 1))
+LISTENER_BACKOFF_MAX = float(os.environ.get("LISTENER_BACKOFF_MAX", 300))
+# a connection has to stay up this long for the backoff to start over
+LISTENER_BACKOFF_RESET = 60
+
+LIBRARY_IDENTIFIER = "com.plexapp.plugins.library"
+# timeline entry states, see plexapi.alert.AlertListener
+STATE_PROCESSED = 5
+STATE_DELETED = 9
+# metadata types
+ITEM_TYPES = {1, 4}  # movie, episode
+PLAYLIST_TYPE = 15
+
+
+def add_task(session, sd, name, func, args):
+    task = Task(
+        name="{} on {}".format(name, sd.name),
+        func=func,
+        args=args,
+        kwargs={},
+        storage_device_id=sd.id,
+    )
+    session.add(task)
+    session.commit()
+    publish_created(task)
+    add_task_to_queue(task.id, PRIORITY_SCHEDULED)
+
+
+def queue_changes(rating_keys, playlist_changed=False, missed=False):
+    """Queue the work for a batch of changes from the listener.
+
+    Changed items are brought up to date with sync_items on the connected
+    storage devices that hold them. Items no device holds yet may be newly
+    added episodes, they go to every device that syncs all episodes.
+    get_files is queued for devices with a sync playlist when a playlist
+    changed, and for every device when notifications may have been missed,
+    it only looks at what changed since its last run.
+    """
+    with database.SessionLocal() as session:
+        held = {}
+        if rating_keys:
+            for sd_id, rating_key in session.execute(
+                sa.select(File.storage_device_id, File.rating_key).where(
+                    File.rating_key.in_(rating_keys)
+                )
+            ):
+                held.setdefault(sd_id, set()).add(rating_key)
+        unknown = set(rating_keys).difference(*held.values())
+        devices = session.execute(sa.select(StorageDevice)).scalars().all()
+        for sd in devices:
+            if missed or (playlist_changed and sd.sync_playlist):
+                add_task(session, sd, "Sync from Plex", "get_files", [sd.id])
+            keys = held.get(sd.id, set())
+            if sd.sync_all_episodes:
+                keys = keys | unknown
+            if keys and sd.connected:
+                add_task(
+                    session,
+                    sd,
+                    "Sync {} changed items".format(len(keys)),
+                    "sync_items",
+                    [sd.id, sorted(keys)],
+                )
+
+
+class PlexListener:
+    """Listen to the Plex server's notifications and queue targeted updates.
+
+    Items that have been added, updated, deleted or stopped playing, and
+    changed playlists, are collected and handed to on_changes once
+    notifications quiet down. The connection is retried with exponential
+    backoff, url overrides the server's notification websocket.
+    """
+
+    def __init__(
+        self,
+        url=PLEX_NOTIFICATIONS_URL,
+        debounce=LISTENER_DEBOUNCE,
+        max_delay=LISTENER_MAX_DELAY,
+        on_changes=queue_changes,
+    ):
+        if websocket is None:
+            raise RuntimeError(
+                "websocket-client isn't installed, install it or set "
+                "PLEX_LISTENER=0 to only sync on a schedule"
+            )
+        self.url = url
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.on_changes = on_changes
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.ws = None
+        self.connections = 0
+        self.reset()
+
+    def reset(self):
+        # must be called with the lock held, or before the listener starts
+        self.rating_keys = set()
+        self.playlist_changed = False
+        self.missed = False
+        self.first_change = None
+        self.last_change = None
+
+    def get_url(self):
+        if self.url:
+            return self.url
+        return (
+            get_client()
+            .url(AlertListener.key, includeToken=True)
+            .replace("http", "ws", 1)
+        )
+
+    def handle(self, container):
+        rating_keys = set()
+        playlist_changed = False
+        kind = container.get("type")
+        if kind == "timeline":
+            for entry in container.get("TimelineEntry", []):
+                if entry.get("identifier") != LIBRARY_IDENTIFIER:
+                    continue
+                if entry.get("state") not in (STATE_PROCESSED, STATE_DELETED):
+                    continue
+                if entry.get("type") == PLAYLIST_TYPE:
+                    playlist_changed = True
+                elif entry.get("type") in ITEM_TYPES:
+                    rating_keys.add(int(entry["itemID"]))
+        elif kind == "playing":
+            for entry in container.get("PlaySessionStateNotification", []):
+                if entry.get("state") == "stopped":
+                    rating_keys.add(int(entry["ratingKey"]))
+        if rating_keys or playlist_changed:
+            self.changed(rating_keys, playlist_changed)
+
+    def changed(self, rating_keys=(), playlist_changed=False, missed=False):
+        now = monotonic()
+        with self.lock:
+            self.rating_keys.update(rating_keys)
+            self.playlist_changed = self.playlist_changed or playlist_changed
+            self.missed = self.missed or missed
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+
+    def flush(self, force=False):
+        now = monotonic()
+        with self.lock:
+            if self.first_change is None:
+                return False
+            if not force and (
+                now - self.last_change < self.debounce
+                and now - self.first_change < self.max_delay
+            ):
+                return False
+            rating_keys = self.rating_keys
+            playlist_changed = self.playlist_changed
+            missed = self.missed
+            self.reset()
+        logger.info(
+            "Queueing {} changed items{}{}".format(
+                len(rating_keys),
+                ", playlist changed" if playlist_changed else "",
+                ", resync" if missed else "",
+            )
+        )
+        try:
+            self.on_changes(rating_keys, playlist_changed, missed)
+        except Exception as e:
+            logger.error("Unable to queue changes")
+            logger.exception(e)
+        return True
+
+    def flush_loop(self):
+        while not self.stop_event.wait(min(self.debounce, 1)):
+            self.flush()
+
+    def on_open(self, ws):
+        self.connections += 1
+        logger.info("Plex listener connected")
+        if self.connections > 1:
+            # anything that changed while disconnected was missed
+            self.changed(missed=True)
+
+    def on_message(self, ws, message):
+        try:
+            self.handle(json.loads(message)["NotificationContainer"])
+        except Exception as e:
+            logger.error("Unable to handle notification {}".format(message))
+            logger.exception(e)
+
+    def on_error(self, ws, error):
+        logger.warning("Plex listener error: {}".format(error))
+
+    def run(self):
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        delay = LISTENER_BACKOFF_MIN
+        while not self.stop_event.is_set():
+            started = monotonic()
+            try:
+                self.ws = websocket.WebSocketApp(
+                    self.get_url(),
+                    on_open=self.on_open,
+                    on_message=self.on_message,
+                    on_error=self.on_error,
+                )
+                self.ws.run_forever(ping_interval=30, ping_timeout=10)
+            except Exception as e:
+                logger.warning("Plex listener unable to connect: {}".format(e))
+            if self.stop_event.is_set():
+                break
+            if monotonic() - started >= LISTENER_BACKOFF_RESET:
+                delay = LISTENER_BACKOFF_MIN
+            logger.info("Plex listener reconnecting in {:g}s".format(delay))
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, LISTENER_BACKOFF_MAX)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.ws is not None:
+            self.ws.close()
@@ -2,15 +2,21 @@ import asyncio
 import os
 import threading
 from contextlib import asynccontextmanager
+from datetime import date, datetime
 
 import crud
 import database
+import listener
 import models
+import planner
+import retention
 import schemas
 import tasks
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
+from events import stream_task_events
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from plexapi.exceptions import Unauthorized
 from sqlalchemy.orm import Session
@@ -23,12 +29,18 @@ from sqlalchemy.orm import Session
 # and stop the thread when the app stops
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    loop = asyncio.get_event_loop()
-    thread = threading.Thread(target=tasks.process_task_queue)
+    thread = threading.Thread(target=tasks.process_task_queue, daemon=True)
     thread.start()
+    threading.Thread(target=retention.retention_loop, daemon=True).start()
+    plex_listener = None
+    if listener.PLEX_LISTENER:
+        plex_listener = listener.PlexListener()
+        threading.Thread(target=plex_listener.run, daemon=True).start()
     yield
     # Stop the thread when the app stops
-    loop.call_soon_threadsafe(tasks.stop_task_queue)
+    if plex_listener is not None:
+        plex_listener.stop()
+    await asyncio.to_thread(tasks.stop_task_queue)
 
 
 app = FastAPI(title="my app root", lifespan=lifespan)
@@ -58,8 +70,12 @@ api_app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+TASK_SORT_PATTERN = "^-?(id|created)$"
+FILE_SORT_PATTERN = "^-?(id|title)$"
+
 
 def get_db():
     db = database.SessionLocal()
@@ -69,12 +85,71 @@ def get_db():
         db.close()
 
 
+def set_next_cursor(response: Response, next_cursor: str | None):
+    # keyset pagination, pass the header back as cursor to get the next page
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+
 @api_app.get("/tasks/", response_model=list[schemas.Task])
-def read_tasks(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    tasks = crud.get_tasks(db, skip=skip, limit=limit)
+def read_tasks(
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    sort: str = Query("-id", pattern=TASK_SORT_PATTERN),
+    status: list[schemas.TaskStatus] | None = Query(None),
+    storage_device_id: int | None = None,
+    func: list[str] | None = Query(None),
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    db: Session = Depends(get_db),
+):
+    try:
+        tasks, next_cursor = crud.get_tasks(
+            db,
+            cursor=cursor,
+            limit=limit,
+            sort=sort,
+            status=status,
+            storage_device_id=storage_device_id,
+            func=func,
+            created_after=created_after,
+            created_before=created_before,
+        )
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    set_next_cursor(response, next_cursor)
     return tasks
 
 
+@api_app.get("/tasks/events/")
+async def read_task_events(
+    request: Request,
+    cursor: str | None = None,
+    last_event_id: str | None = Header(None),
+):
+    # EventSource sends the id of the last event it saw when it reconnects
+    return StreamingResponse(
+        stream_task_events(request, cursor if cursor is not None else last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api_app.get("/tasks/metrics/", response_model=schemas.TaskMetrics)
+def read_task_metrics():
+    return crud.get_task_metrics()
+
+
+@api_app.get("/tasks/summary/", response_model=list[schemas.TaskSummary])
+def read_task_summaries(
+    start: date | None = None,
+    end: date | None = None,
+    db: Session = Depends(get_db),
+):
+    return crud.get_task_summaries(db, start=start, end=end)
+
+
 @api_app.post("/tasks/", response_model=schemas.Task)
 def create_task(task: schemas.TaskCreate, db: Session = Depends(get_db)):
     return crud.create_task(db=db, task=task)
@@ -110,13 +185,106 @@ def create_storage_device(
     return crud.create_storage_device(db=db, storage_device=storage_device)
 
 
+@api_app.patch("/storage_devices/{device_id}/", response_model=schemas.StorageDevice)
+def update_storage_device(
+    device_id: int,
+    storage_device: schemas.StorageDeviceUpdate,
+    db: Session = Depends(get_db),
+):
+    try:
+        db_storage_device = crud.update_storage_device(
+            db=db, device_id=device_id, storage_device=storage_device
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if db_storage_device is None:
+        raise HTTPException(status_code=404, detail="Storage device not found")
+    return db_storage_device
+
+
 @api_app.get("/storage_devices/{device_id}/files/", response_model=list[schemas.File])
 def read_files(
-    device_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+    device_id: int,
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    sort: str = Query("id", pattern=FILE_SORT_PATTERN),
+    status: list[schemas.FileStatus] | None = Query(None),
+    db: Session = Depends(get_db),
 ):
-    return crud.get_files_for_storage_device(
-        db, device_id=device_id, skip=skip, limit=limit
-    )
+    try:
+        files, next_cursor = crud.get_files_for_storage_device(
+            db,
+            device_id=device_id,
+            cursor=cursor,
+            limit=limit,
+            sort=sort,
+            status=status,
+        )
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    set_next_cursor(response, next_cursor)
+    return files
+
+
+@api_app.get("/storage_devices/{device_id}/plan/", response_model=schemas.TransferPlan)
+def read_transfer_plan(
+    device_id: int,
+    file_ids: list[int] | None = Query(None),
+    reserve: int | None = Query(None, ge=0),
+    db: Session = Depends(get_db),
+):
+    # what transfer_files, or transfer_some_files with file_ids, would copy
+    try:
+        plan = crud.get_transfer_plan(
+            db,
+            device_id=device_id,
+            file_ids=file_ids,
+            reserve=reserve if reserve is not None else planner.DEVICE_RESERVE,
+        )
+    except crud.DeviceNotConnected as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Storage device not found")
+    return plan
+
+
+@api_app.get(
+    "/storage_devices/{device_id}/eviction/", response_model=schemas.EvictionPlan
+)
+def read_eviction_plan(
+    device_id: int,
+    policy: list[str] | None = Query(None),
+    reserve: int | None = Query(None, ge=0),
+    db: Session = Depends(get_db),
+):
+    # dry run, the files transfer_files would evict with the device's
+    # eviction_policy, or the given policies, to fit what's deferred
+    try:
+        plan = crud.get_eviction_plan(
+            db,
+            device_id=device_id,
+            policies=policy,
+            reserve=reserve if reserve is not None else planner.DEVICE_RESERVE,
+        )
+    except crud.DeviceNotConnected as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Storage device not found")
+    return plan
+
+
+@api_app.get("/bandwidth/", response_model=schemas.BandwidthLimits)
+def read_bandwidth_limits():
+    return crud.get_bandwidth_limits()
+
+
+@api_app.put("/bandwidth/", response_model=schemas.BandwidthLimits)
+def update_bandwidth_limits(limits: schemas.BandwidthLimits):
+    # applies to running transfers from their next chunk
+    return crud.update_bandwidth_limits(limits)
 
 
 @api_app.patch(
@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+# seconds a scan is trusted for, GatoSnap's own writes and deletes are applied
+# to it straight away but files changed by anything else only show up after a
+# rescan
+MANIFEST_TTL = float(os.environ.get("MANIFEST_TTL", 10 * 60))
+
+
+def scan(base_path):
+    """Return {path: (size, mtime)} for every file under base_path."""
+    files = {}
+    directories = [base_path]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[os.path.normpath(entry.path)] = (
+                            stat.st_size,
+                            stat.st_mtime,
+                        )
+                except FileNotFoundError:
+                    continue
+    return files
+
+
+class ManifestCache:
+    """Per storage device index of the files on it, built with one scan.
+
+    Lookups are served from memory instead of an exists/getsize round trip to
+    the device per file. GatoSnap reports its own writes and deletes with
+    written and removed, a device is scanned again once its manifest is
+    older than MANIFEST_TTL or after invalidate.
+    """
+
+    def __init__(self, ttl=MANIFEST_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # storage device id -> ((base path, st_dev), scanned at, files), st_dev
+        # changes when a different filesystem is mounted at the base path
+        self.manifests = {}
+
+    def get(self, sd, refresh=False):
+        try:
+            device = os.stat(sd.base_path).st_dev
+        except FileNotFoundError:
+            # not plugged in, nothing to cache
+            return Manifest(self, sd.id, {})
+        with self.lock:
+            cached = self.manifests.get(sd.id)
+        if (
+            not refresh
+            and cached is not None
+            and cached[0] == (sd.base_path, device)
+            and monotonic() - cached[1] < self.ttl
+        ):
+            return Manifest(self, sd.id, cached[2])
+        started = monotonic()
+        files = scan(sd.base_path)
+        logger.info(
+            "Scanned {} files on {} in {:0.2f}s".format(
+                len(files), sd.name, monotonic() - started
+            )
+        )
+        with self.lock:
+            self.manifests[sd.id] = ((sd.base_path, device), started, files)
+        return Manifest(self, sd.id, files)
+
+    def written(self, sd_id, path):
+        with self.lock:
+            if sd_id not in self.manifests:
+                return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.removed(sd_id, path)
+            return
+        with self.lock:
+            cached = self.manifests.get(sd_id)
+            if cached is not None:
+                cached[2][os.path.normpath(path)] = (stat.st_size, stat.st_mtime)
+
+    def removed(self, sd_id, path):
+        with self.lock:
+            cached = self.manifests.get(sd_id)
+            if cached is not None:
+                cached[2].pop(os.path.normpath(path), None)
+
+    def invalidate(self, sd_id):
+        with self.lock:
+            self.manifests.pop(sd_id, None)
+
+
+class Manifest:
+    """The files on one storage device, read from a ManifestCache scan."""
+
+    def __init__(self, cache, sd_id, files):
+        self.cache = cache
+        self.sd_id = sd_id
+        self.files = files
+
+    def get(self, path):
+        with self.cache.lock:
+            return self.files.get(os.path.normpath(path))
+
+    def exists(self, path):
+        return self.get(path) is not None
+
+    def getsize(self, path):
+        entry = self.get(path)
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry[0]
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            self.cache.removed(self.sd_id, path)
+            raise
+        self.cache.removed(self.sd_id, path)
+
+    def discard(self, path):
+        """Like remove but the file may already be gone, the manifest can be
+        older than the device. Returns whether there was a file to remove."""
+        try:
+            self.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+manifest_cache = ManifestCache()
@@ -40,6 +40,14 @@ class Task(Base):
     progress = sa.Column(sa.Float, nullable=False, default=0.0)
     total = sa.Column(sa.Float, nullable=False, default=0.0)
     status = sa.Column(sa.Enum(TaskStatus), nullable=False, default=TaskStatus.PENDING)
+    storage_device_id = sa.Column(
+        sa.Integer, sa.ForeignKey("storage_device.id"), nullable=True
+    )
+
+    __table_args__ = (
+        sa.Index("ix_task_status_created", "status", "created"),
+        sa.Index("ix_task_storage_device_id_created", "storage_device_id", "created"),
+    )
 
     # @property
     # def time_elapsed(self):
@@ -96,6 +104,25 @@ class Task(Base):
     #     return self.progress / self.time_elapsed
 
 
+class TaskSummary(Base):
+    """Per day totals of finished and stopped tasks removed from task."""
+
+    __tablename__ = "task_summary"
+    id = sa.Column(sa.Integer, primary_key=True)
+    day = sa.Column(sa.Date, nullable=False)
+    func = sa.Column(sa.String, nullable=False)
+    status = sa.Column(sa.Enum(TaskStatus), nullable=False)
+    count = sa.Column(sa.Integer, nullable=False, default=0)
+    bytes = sa.Column(sa.Float, nullable=False, default=0.0)
+    duration = sa.Column(sa.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        sa.Index(
+            "ix_task_summary_day_func_status", "day", "func", "status", unique=True
+        ),
+    )
+
+
 class StorageDevice(Base):
     __tablename__ = "storage_device"
     id = sa.Column(sa.Integer, primary_key=True)
@@ -105,6 +132,16 @@ class StorageDevice(Base):
     sync_continue_watching = sa.Column(sa.Boolean, nullable=False, default=True)
     sync_all_episodes = sa.Column(sa.Boolean, nullable=False, default=True)
     sync_playlist = sa.Column(sa.String, nullable=True)
+    # watermarks of the last get_files run, see tasks.get_files
+    last_full_sync = sa.Column(sa.DateTime, nullable=True)
+    playlist_updated_at = sa.Column(sa.DateTime, nullable=True)
+    # comma separated eviction policies, see eviction.EVICTION_POLICIES
+    eviction_policy = sa.Column(sa.String, nullable=True)
+    # measured by benchmark.benchmark_device and tuned by transfers since
+    write_throughput = sa.Column(sa.Float, nullable=True)
+    chunk_size = sa.Column(sa.Integer, nullable=True)
+    max_transfers = sa.Column(sa.Integer, nullable=True)
+    benchmarked_at = sa.Column(sa.DateTime, nullable=True)
 
     def get_drive_path(self, path):
         if not path.startswith(SERVER_BASE_PATH):
@@ -145,13 +182,28 @@ class File(Base):
     storage_device = sa.orm.relationship(StorageDevice, backref="files")
     title = sa.Column(sa.String, nullable=False)
     remote_path = sa.Column(sa.String, nullable=False)
-    rating_key = sa.Column(sa.Integer, nullable=False, index=True, unique=True)
+    rating_key = sa.Column(sa.Integer, nullable=False, index=True)
     file_size = sa.Column(sa.Integer, nullable=False)
     status = sa.Column(sa.Enum(FileStatus), nullable=False, default=FileStatus.MISSING)
-
-    constraints = [
-        "UNIQUE(storage_device_id, rating_key)",
-    ]
+    # Plex's updatedAt and lastViewedAt for the item when it was last synced
+    updated_at = sa.Column(sa.DateTime, nullable=True)
+    last_viewed_at = sa.Column(sa.DateTime, nullable=True)
+    # mtime of the source file file_size was read from
+    source_mtime = sa.Column(sa.Float, nullable=True)
+    # "<algorithm>:<hex digest>" of the source recorded by transfer_file
+    checksum = sa.Column(sa.String, nullable=True)
+    # order files are planned in, lower first, see planner.RANK_NEXT_UP
+    rank = sa.Column(sa.Integer, nullable=True)
+
+    __table_args__ = (
+        sa.Index(
+            "ix_file_storage_device_id_rating_key",
+            "storage_device_id",
+            "rating_key",
+            unique=True,
+        ),
+        sa.Index("ix_file_storage_device_id_status", "storage_device_id", "status"),
+    )
 
     @property
     def local_path(self):
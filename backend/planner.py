@@ -0,0 +1,131 @@
+import logging
+import os
+
+import sqlalchemy as sa
+from manifest import manifest_cache
+from models import File, FileStatus, Task, TaskStatus
+from transfer import get_partial_path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+# bytes always left free on a storage device
+DEVICE_RESERVE = int(os.environ.get("DEVICE_RESERVE", 1024 * 1024 * 1024))
+
+# File.rank, lower is transferred first: the next episode to watch of a show,
+# anything else On Deck or in Continue Watching, the sync playlist and then
+# the episodes after the next one, RANK_EPISODES + how many come before it
+RANK_NEXT_UP = 0
+RANK_ON_DECK = 1
+RANK_PLAYLIST = 2
+RANK_EPISODES = 3
+
+
+def get_free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_rank_key(file):
+    # files without a rank go last, smaller files first within a rank
+    return (file.rank is None, file.rank or 0, file.file_size, file.id)
+
+
+def get_queued_transfers(session, sd):
+    """Return {file id: bytes still to copy} for transfers already queued."""
+    tasks = session.execute(
+        sa.select(Task.args, Task.total, Task.progress).where(
+            Task.storage_device_id == sd.id,
+            Task.func == "transfer_file",
+            Task.status.in_([TaskStatus.PENDING, TaskStatus.RUNNING]),
+        )
+    ).all()
+    return {
+        task.args[0]: max((task.total or 0) - (task.progress or 0), 0) for task in tasks
+    }
+
+
+def plan_transfers(session, sd, file_ids=None, reserve=DEVICE_RESERVE):
+    """Work out which files fit on a storage device before copying anything.
+
+    Takes the given files, or every missing one, that aren't on the device
+    or already queued, ranks them with get_rank_key and admits them in order
+    while they fit in the free space less the reserve and what queued
+    transfers will still write. A file that doesn't fit is deferred, smaller
+    files after it can still be admitted.
+    """
+    where = [File.storage_device_id == sd.id]
+    if file_ids is None:
+        where.append(File.status == FileStatus.MISSING)
+    else:
+        where.append(File.id.in_(file_ids))
+    files = session.execute(
+        sa.select(
+            File.id,
+            File.title,
+            File.remote_path,
+            File.file_size,
+            File.rank,
+        ).where(*where)
+    ).all()
+    manifest = manifest_cache.get(sd)
+    queued = get_queued_transfers(session, sd)
+    free = get_free_space(sd.base_path)
+    available = free - reserve - sum(queued.values())
+    plan = {
+        "storage_device_id": sd.id,
+        "free": free,
+        "reserve": reserve,
+        "queued": sum(queued.values()),
+        "bytes_in": 0,
+        "bytes_out": 0,
+        "bytes_deferred": 0,
+        "admitted": [],
+        "deferred": [],
+        "synced": [],
+    }
+    for file in sorted(files, key=get_rank_key):
+        if file.id in queued:
+            continue
+        storage_path = sd.get_drive_path(file.remote_path)
+        on_device = manifest.get(storage_path)
+        if on_device is not None and on_device[0] == file.file_size:
+            plan["synced"].append(file.id)
+            continue
+        partial = manifest.get(get_partial_path(storage_path))
+        # a resumed transfer only writes the rest, or nothing once the partial
+        # file is preallocated, a changed copy is only replaced once the new
+        # one is complete so it doesn't free anything
+        needed = file.file_size - (partial[0] if partial is not None else 0)
+        entry = {
+            "id": file.id,
+            "title": file.title,
+            "remote_path": file.remote_path,
+            "file_size": file.file_size,
+            "rank": file.rank,
+            "bytes": max(needed, 0),
+        }
+        if entry["bytes"] <= available:
+            available -= entry["bytes"]
+            plan["admitted"].append(entry)
+            plan["bytes_in"] += entry["bytes"]
+            if on_device is not None:
+                plan["bytes_out"] += on_device[0]
+        else:
+            plan["deferred"].append(entry)
+            plan["bytes_deferred"] += entry["bytes"]
+    logger.info(
+        "Planned {} files ({} bytes) for {}, deferred {} ({} bytes)".format(
+            len(plan["admitted"]),
+            plan["bytes_in"],
+            sd.name,
+            len(plan["deferred"]),
+            plan["bytes_deferred"],
+        )
+    )
+    return plan
@@ -11,12 +11,20 @@ CODES_URL = "https://plex.tv/api/v2/pins.json?strong=true"
 AUTH_URL = "https://app.plex.tv/auth#!?{}"
 TOKEN_URL = "https://plex.tv/api/v2/pins/{}"
 
+import threading
+
 import requests
 import yaml
+from plexapi.exceptions import NotFound
 from plexapi.myplex import MyPlexAccount, PlexServer
+from requests.adapters import HTTPAdapter
 
 AUTH_TOKEN_FILE = "auth_token.yml"
 BASE_URL_FILE = "base_url.yml"
+# rating keys looked up per /library/metadata/<key1,key2,...> request
+PLEX_FETCH_BATCH_SIZE = int(os.environ.get("PLEX_FETCH_BATCH_SIZE", 100))
+# keep-alive connections kept open to the Plex server, one per worker is plenty
+PLEX_POOL_SIZE = int(os.environ.get("PLEX_POOL_SIZE", 10))
 
 
 class NoAuthException(Exception):
@@ -27,6 +35,38 @@ class NoServerException(Exception):
     pass
 
 
+class PlexClientManager:
+    """Process-wide PlexServer shared by the API and the worker threads.
+
+    The server is connected once and reused, with every request going
+    through one pooled keep-alive session. invalidate() drops it so the next
+    get_client() picks up a changed auth token or base url.
+    """
+
+    def __init__(self, pool_size=PLEX_POOL_SIZE):
+        self.lock = threading.Lock()
+        self.client = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = PlexServer(
+                    get_base_url(), get_auth_token(), session=self.session
+                )
+            return self.client
+
+    def invalidate(self):
+        with self.lock:
+            self.client = None
+
+
+plex_client_manager = PlexClientManager()
+
+
 def save_auth_token(username, password):
     try:
         os.remove(AUTH_TOKEN_FILE)
@@ -38,6 +78,7 @@ def save_auth_token(username, password):
         {"authenticationToken": account.authenticationToken}, open(AUTH_TOKEN_FILE, "w")
     )
     os.chmod(AUTH_TOKEN_FILE, 0o600)
+    plex_client_manager.invalidate()
 
 
 def get_auth_token():
@@ -55,6 +96,7 @@ def save_base_url(base_url):
     with open(BASE_URL_FILE, "w") as f:
         yaml.dump({"base_url": base_url}, f)
     os.chmod(BASE_URL_FILE, 0o600)
+    plex_client_manager.invalidate()
 
 
 def get_base_url():
@@ -70,14 +112,26 @@ def get_base_url():
 
 def get_account():
     auth_token = get_auth_token()
-    return MyPlexAccount(token=auth_token)
+    return MyPlexAccount(token=auth_token, session=plex_client_manager.session)
 
 
 def get_client():
-    base_url = get_base_url()
-    auth_token = get_auth_token()
-    plex = PlexServer(
-        base_url,
-        auth_token,
-    )
-    return plex
+    return plex_client_manager.get_client()
+
+
+def fetch_items(plex, rating_keys, batch_size=PLEX_FETCH_BATCH_SIZE):
+    """Fetch the metadata for many rating keys with one request per batch.
+
+    Returns a dict of rating key to item, keys Plex doesn't know are left out.
+    """
+    rating_keys = list(rating_keys)
+    items = {}
+    for start in range(0, len(rating_keys), batch_size):
+        batch = rating_keys[start : start + batch_size]
+        try:
+            fetched = plex.fetchItems(batch)
+        except NotFound:
+            continue
+        for item in fetched:
+            items[item.ratingKey] = item
+    return items
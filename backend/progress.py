@@ -0,0 +1,134 @@
+import os
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+
+from events import task_events
+from models import TaskStatus
+
+# how often a running task's progress is written to the task table, state
+# transitions are always written straight away
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 5))
+PROGRESS_FLUSH_UPDATES = int(os.environ.get("PROGRESS_FLUSH_UPDATES", 100))
+
+
+def utcnow():
+    # matches the naive UTC timestamps sqlite's now() stores
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class ProgressRegistry:
+    """Thread-safe, in-memory progress of the tasks that are currently running.
+
+    Workers report every update here and only write to the database when
+    should_flush says so, the API reads live progress from here instead.
+    Every update is also published to task_events.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+
+    def start(self, task_id, progress=0.0, total=0.0):
+        with self.lock:
+            self.tasks[task_id] = {
+                "progress": progress,
+                "total": total,
+                "status": TaskStatus.RUNNING,
+                "flushed_status": TaskStatus.RUNNING,
+                "flushed_at": monotonic(),
+                "updates": 0,
+            }
+        task_events.publish(
+            task_id,
+            "status",
+            {
+                "progress": progress,
+                "total": total,
+                "status": TaskStatus.RUNNING,
+                "started": utcnow(),
+                "finished": None,
+            },
+        )
+
+    def update(self, task_id, progress=None, increment=None, total=None, status=None):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                return
+            # a stopped task keeps its status until the worker notices
+            if entry["status"] == TaskStatus.STOPPED:
+                status = None
+            if progress:
+                entry["progress"] = progress
+            elif increment:
+                entry["progress"] += increment
+            if total:
+                entry["total"] = total
+            changed = status is not None and status != entry["status"]
+            if status is not None:
+                entry["status"] = status
+            entry["updates"] += 1
+            data = {
+                "progress": entry["progress"],
+                "total": entry["total"],
+                "status": entry["status"],
+            }
+        if changed and status in (TaskStatus.SUCCESS, TaskStatus.FAILED):
+            data["finished"] = utcnow()
+        task_events.publish(task_id, "status" if changed else "progress", data)
+
+    def should_flush(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                return False
+            return (
+                entry["status"] != entry["flushed_status"]
+                or entry["updates"] >= PROGRESS_FLUSH_UPDATES
+                or monotonic() - entry["flushed_at"] >= PROGRESS_FLUSH_INTERVAL
+            )
+
+    def flushed(self, task_id):
+        """Return the values to write for a task and mark them as written."""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                return None
+            entry["flushed_status"] = entry["status"]
+            entry["flushed_at"] = monotonic()
+            entry["updates"] = 0
+            return {
+                "progress": entry["progress"],
+                "total": entry["total"],
+                "status": entry["status"],
+            }
+
+    def stop(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is not None:
+                entry["status"] = TaskStatus.STOPPED
+
+    def is_stopped(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            return entry is not None and entry["status"] == TaskStatus.STOPPED
+
+    def remove(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+
+    def get(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                return None
+            return {
+                "progress": entry["progress"],
+                "total": entry["total"],
+                "status": entry["status"],
+            }
+
+
+progress_registry = ProgressRegistry()
@@ -0,0 +1,131 @@
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from time import sleep
+
+import database
+import sqlalchemy as sa
+from events import task_events
+from models import Task, TaskStatus, TaskSummary
+from sqlalchemy.dialects.sqlite import insert
+from tasks import TRANSFER_FUNCS, shutdown_event
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+# finished and stopped tasks are kept for TASK_RETENTION_DAYS days, and at
+# most the newest TASK_RETENTION_ROWS of them, older ones are rolled into
+# task_summary
+TASK_RETENTION_DAYS = int(os.environ.get("TASK_RETENTION_DAYS", 30))
+TASK_RETENTION_ROWS = int(os.environ.get("TASK_RETENTION_ROWS", 10000))
+TASK_RETENTION_INTERVAL = int(os.environ.get("TASK_RETENTION_INTERVAL", 60 * 60))
+# rows removed per transaction, kept small so the write lock is released often
+TASK_RETENTION_BATCH = int(os.environ.get("TASK_RETENTION_BATCH", 500))
+
+FINISHED_STATUSES = (TaskStatus.SUCCESS, TaskStatus.FAILED, TaskStatus.STOPPED)
+
+
+def get_expired_filter(session):
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+        days=TASK_RETENTION_DAYS
+    )
+    # a stopped task has no finished time, it's aged from when it was created
+    expired = sa.func.coalesce(Task.finished, Task.created) < cutoff
+    # id of the newest finished task past the row limit
+    last_kept_id = session.execute(
+        sa.select(Task.id)
+        .where(Task.status.in_(FINISHED_STATUSES))
+        .order_by(Task.id.desc())
+        .offset(TASK_RETENTION_ROWS)
+        .limit(1)
+    ).scalar_one_or_none()
+    if last_kept_id is not None:
+        expired = sa.or_(expired, Task.id <= last_kept_id)
+    return sa.and_(Task.status.in_(FINISHED_STATUSES), expired)
+
+
+def summarise(tasks):
+    summaries = defaultdict(lambda: {"count": 0, "bytes": 0.0, "duration": 0.0})
+    for task in tasks:
+        moment = task.finished or task.created or task.started or datetime.now()
+        day = moment.date()
+        summary = summaries[(day, task.func, task.status)]
+        summary["count"] += 1
+        if task.func in TRANSFER_FUNCS:
+            summary["bytes"] += task.total or 0.0
+        if task.started is not None and task.finished is not None:
+            summary["duration"] += (task.finished - task.started).total_seconds()
+    return [
+        {"day": day, "func": func, "status": status, **summary}
+        for (day, func, status), summary in summaries.items()
+    ]
+
+
+def compact_batch(session, expired):
+    tasks = session.execute(
+        sa.select(
+            Task.id,
+            Task.func,
+            Task.status,
+            Task.total,
+            Task.created,
+            Task.started,
+            Task.finished,
+        )
+        .where(expired)
+        .order_by(Task.id)
+        .limit(TASK_RETENTION_BATCH)
+    ).all()
+    if not tasks:
+        return 0
+    statement = insert(TaskSummary).values(summarise(tasks))
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=["day", "func", "status"],
+            set_={
+                "count": TaskSummary.count + statement.excluded["count"],
+                "bytes": TaskSummary.bytes + statement.excluded["bytes"],
+                "duration": TaskSummary.duration + statement.excluded["duration"],
+            },
+        )
+    )
+    session.execute(sa.delete(Task).where(Task.id.in_([task.id for task in tasks])))
+    session.commit()
+    for task in tasks:
+        task_events.publish(task.id, "deleted", {})
+    return len(tasks)
+
+
+def compact_tasks():
+    """Roll expired finished and stopped tasks into task_summary, one small
+    batch at a time."""
+    removed = 0
+    with database.SessionLocal() as session:
+        expired = get_expired_filter(session)
+        session.commit()
+        while not shutdown_event.is_set():
+            count = compact_batch(session, expired)
+            if count == 0:
+                break
+            removed += count
+            # let the workers and the API get the write lock in between batches
+            sleep(0.05)
+    if removed:
+        logger.info("Compacted {} finished and stopped tasks".format(removed))
+    return removed
+
+
+def retention_loop():
+    while not shutdown_event.is_set():
+        try:
+            compact_tasks()
+        except Exception as e:
+            logger.error("Unable to compact tasks")
+            logger.exception(e)
+        shutdown_event.wait(TASK_RETENTION_INTERVAL)
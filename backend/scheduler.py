@@ -0,0 +1,248 @@
+import itertools
+import logging
+import statistics
+import threading
+from bisect import insort
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+METADATA_LANE = "metadata"
+TRANSFER_LANE = "transfer"
+
+# lower runs first, FIFO within the same priority
+PRIORITY_USER = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_BACKGROUND = 2
+
+# number of recent enqueue to start latencies kept for metrics
+LATENCY_WINDOW = 1000
+
+
+class DeviceScheduler:
+    """Run tasks in separate lanes for metadata work and bulk transfers.
+
+    Metadata tasks run on their own small pool. Transfers are queued per
+    target storage device and started round robin across devices, never
+    running more than max_per_device at once on a device, or the device's
+    own limit from set_device_limit, or more than max_per_source at once
+    from a source volume. Work started outside the lane can hold a device's
+    slots with acquire and release. Within a lane the waiting task with the
+    best priority starts first.
+    """
+
+    def __init__(
+        self,
+        run,
+        max_metadata_workers,
+        max_transfer_workers,
+        max_per_device,
+        max_per_source,
+    ):
+        self.run = run
+        self.max_metadata_workers = max_metadata_workers
+        self.max_transfer_workers = max_transfer_workers
+        self.max_per_device = max_per_device
+        self.max_per_source = max_per_source
+        self.metadata_executor = ThreadPoolExecutor(
+            max_workers=max_metadata_workers, thread_name_prefix="metadata"
+        )
+        self.transfer_executor = ThreadPoolExecutor(
+            max_workers=max_transfer_workers, thread_name_prefix="transfer"
+        )
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        # waiting entries are kept sorted as (priority, seq, task_id, source, enqueued)
+        self.metadata_pending = []
+        self.metadata_running = 0
+        # device -> transfers waiting for that device
+        self.pending = OrderedDict()
+        self.running = 0
+        self.running_per_device = Counter()
+        # device -> transfer seconds run on it, running_per_device integrated
+        # over time up to load_updated[device]
+        self.load = Counter()
+        self.load_updated = {}
+        self.device_limits = {}
+        # devices held by acquire(exclusive=True), nothing else starts on them
+        self.exclusive = set()
+        self.running_per_source = Counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.started = 0
+
+    def submit(
+        self,
+        task_id,
+        lane,
+        device=None,
+        source=None,
+        priority=PRIORITY_SCHEDULED,
+        enqueued=None,
+    ):
+        entry = (
+            priority,
+            next(self.counter),
+            task_id,
+            source,
+            enqueued if enqueued is not None else monotonic(),
+        )
+        with self.lock:
+            if lane == METADATA_LANE:
+                insort(self.metadata_pending, entry)
+            else:
+                insort(self.pending.setdefault(device, []), entry)
+            self._dispatch()
+
+    def set_device_limit(self, device, limit):
+        with self.lock:
+            if limit is None:
+                self.device_limits.pop(device, None)
+            else:
+                self.device_limits[device] = max(limit, 1)
+            self._dispatch()
+
+    def get_load(self, device):
+        """Transfer seconds run on device so far. The difference between two
+        calls divided by the time between them is the average number of
+        transfers running on the device in that time."""
+        with self.lock:
+            self._add_running(device, 0)
+            return self.load[device]
+
+    def _add_running(self, device, change):
+        # must be called with the lock held
+        now = monotonic()
+        self.load[device] += self.running_per_device[device] * (
+            now - self.load_updated.get(device, now)
+        )
+        self.load_updated[device] = now
+        self.running_per_device[device] += change
+
+    def acquire(self, device, exclusive=False):
+        """Take a transfer slot on device for work started outside the lane,
+        returning False if the device is already at its limit. An exclusive
+        slot is only taken when nothing is running on the device and keeps
+        anything else from starting on it until it's released."""
+        with self.lock:
+            limit = self.device_limits.get(device, self.max_per_device)
+            running = self.running_per_device[device]
+            if device in self.exclusive or running >= limit:
+                return False
+            if exclusive:
+                if running:
+                    return False
+                self.exclusive.add(device)
+            self._add_running(device, 1)
+            return True
+
+    def release(self, device):
+        with self.lock:
+            self._add_running(device, -1)
+            self.exclusive.discard(device)
+            self._dispatch()
+
+    def _next_for_device(self, device):
+        # index of the best waiting transfer allowed to start on this device
+        limit = self.device_limits.get(device, self.max_per_device)
+        if device in self.exclusive or self.running_per_device[device] >= limit:
+            return None
+        for index, entry in enumerate(self.pending[device]):
+            if self.running_per_source[entry[3]] < self.max_per_source:
+                return index
+        return None
+
+    def _record_start(self, entry):
+        self.started += 1
+        self.latencies.append(monotonic() - entry[4])
+
+    def _dispatch(self):
+        # must be called with the lock held
+        while (
+            self.metadata_pending and self.metadata_running < self.max_metadata_workers
+        ):
+            entry = self.metadata_pending.pop(0)
+            self.metadata_running += 1
+            self._record_start(entry)
+            self.metadata_executor.submit(self._run_metadata, entry[2])
+        while self.running < self.max_transfer_workers:
+            # pick the best priority across devices, ties go to the device
+            # that has waited longest for a turn
+            best = None
+            for device in self.pending:
+                index = self._next_for_device(device)
+                if index is None:
+                    continue
+                entry = self.pending[device][index]
+                if best is None or entry[0] < best[2][0]:
+                    best = (device, index, entry)
+            if best is None:
+                return
+            device, index, entry = best
+            del self.pending[device][index]
+            # move the device to the back so the others get a turn first
+            if self.pending[device]:
+                self.pending.move_to_end(device)
+            else:
+                del self.pending[device]
+            task_id, source = entry[2], entry[3]
+            self.running += 1
+            self._add_running(device, 1)
+            self.running_per_source[source] += 1
+            self._record_start(entry)
+            logger.debug("Starting transfer {} on device {}".format(task_id, device))
+            self.transfer_executor.submit(self._run, task_id, device, source)
+
+    def _run_metadata(self, task_id):
+        try:
+            self.run(task_id)
+        finally:
+            with self.lock:
+                self.metadata_running -= 1
+                self._dispatch()
+
+    def _run(self, task_id, device, source):
+        try:
+            self.run(task_id)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self._add_running(device, -1)
+                self.running_per_source[source] -= 1
+                self._dispatch()
+
+    def metrics(self):
+        with self.lock:
+            last = self.latencies[-1] if self.latencies else None
+            latencies = sorted(self.latencies)
+            metrics = {
+                "started": self.started,
+                "pending": len(self.metadata_pending)
+                + sum(len(waiting) for waiting in self.pending.values()),
+                "running": self.metadata_running + self.running,
+            }
+        if latencies:
+            metrics["latency"] = {
+                "last": last,
+                "mean": statistics.fmean(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[int(len(latencies) * 0.95)],
+                "max": latencies[-1],
+            }
+        else:
+            metrics["latency"] = None
+        return metrics
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            self.metadata_pending.clear()
+            self.pending.clear()
+        self.metadata_executor.shutdown(wait=wait, cancel_futures=True)
+        self.transfer_executor.shutdown(wait=wait, cancel_futures=True)
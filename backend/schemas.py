@@ -29,6 +29,7 @@ class TaskBase(BaseModel):
     progress: float | None
     total: float | None
     status: TaskStatus = TaskStatus.PENDING
+    storage_device_id: int | None = None
 
 
 class Task(TaskBase):
@@ -44,6 +45,7 @@ class TaskCreate(TaskBase):
     func: str
     progress: None = None
     total: None = None
+    storage_device_id: None = None
 
 
 class TaskUpdate(TaskBase):
@@ -57,9 +59,46 @@ class TaskUpdate(TaskBase):
     finished: None = None
     progress: None = None
     total: None = None
+    storage_device_id: None = None
     status: TaskStatus = TaskStatus.PENDING
 
 
+class TaskSummary(BaseModel):
+    day: date
+    func: str
+    status: TaskStatus
+    count: int
+    bytes: float
+    duration: float
+
+    class Config:
+        from_attributes = True
+
+
+class TaskLatency(BaseModel):
+    last: float
+    mean: float
+    p50: float
+    p95: float
+    max: float
+
+
+class PageCache(BaseModel):
+    cached: int
+    dirty: int
+    writeback: int
+
+
+class TaskMetrics(BaseModel):
+    started: int
+    pending: int
+    running: int
+    latency: TaskLatency | None
+    page_cache: PageCache | None
+    # bytes transferred by each copy method, e.g. copy_file_range or pipeline
+    copy_methods: dict[str, int] = {}
+
+
 class StorageDeviceBase(BaseModel):
     id: int
     name: str
@@ -68,6 +107,12 @@ class StorageDeviceBase(BaseModel):
     sync_continue_watching: bool
     sync_playlist: str | None
     connected: bool | None = None
+    last_full_sync: datetime | None = None
+    eviction_policy: str | None = None
+    write_throughput: float | None = None
+    chunk_size: int | None = None
+    max_transfers: int | None = None
+    benchmarked_at: datetime | None = None
 
 
 class StorageDevice(StorageDeviceBase):
@@ -78,6 +123,11 @@ class StorageDevice(StorageDeviceBase):
 class StorageDeviceCreate(StorageDeviceBase):
     id: None = None
     connected: None = None
+    last_full_sync: None = None
+    write_throughput: None = None
+    chunk_size: None = None
+    max_transfers: None = None
+    benchmarked_at: None = None
     name: str
     base_path: str
     sync_on_deck: bool
@@ -85,6 +135,15 @@ class StorageDeviceCreate(StorageDeviceBase):
     sync_playlist: str | None = None
 
 
+class StorageDeviceUpdate(BaseModel):
+    # only the fields that are sent are changed
+    name: str | None = None
+    sync_on_deck: bool | None = None
+    sync_continue_watching: bool | None = None
+    sync_playlist: str | None = None
+    eviction_policy: str | None = None
+
+
 class FileStatusUpdate(BaseModel):
     status: FileStatus
     file_ids: list[int]
@@ -99,6 +158,8 @@ class FileBase(BaseModel):
     rating_key: int
     file_size: int
     status: FileStatus = FileStatus.MISSING
+    checksum: str | None = None
+    rank: int | None = None
 
 
 class File(FileBase):
@@ -114,9 +175,59 @@ class FileUpdate(FileBase):
     storage_path: None = None
     rating_key: None = None
     file_size: None = None
+    checksum: None = None
+    rank: None = None
     status: FileStatus = FileStatus.MISSING
 
 
+class PlannedFile(BaseModel):
+    id: int
+    title: str
+    file_size: int
+    rank: int | None
+    bytes: int
+
+
+class TransferPlan(BaseModel):
+    storage_device_id: int
+    free: int
+    reserve: int
+    queued: float
+    bytes_in: int
+    bytes_out: int
+    bytes_deferred: int
+    admitted: list[PlannedFile]
+    deferred: list[PlannedFile]
+    synced: list[int]
+
+
+class Eviction(BaseModel):
+    policies: list[str]
+    bytes_freed: int
+    evicted: list[PlannedFile]
+    admitted: list[PlannedFile]
+
+
+class EvictionPlan(BaseModel):
+    plan: TransferPlan
+    eviction: Eviction
+
+
+class BandwidthWindow(BaseModel):
+    # replaces the global limit from start until end, may span midnight
+    start: time
+    end: time
+    limit: int | None
+
+
+class BandwidthLimits(BaseModel):
+    # bytes per second, None is unlimited
+    limit: int | None = None
+    sources: dict[str, int | None] = {}
+    devices: dict[int, int | None] = {}
+    schedule: list[BandwidthWindow] = []
+
+
 class PlexServer(BaseModel):
     device: str
     name: str
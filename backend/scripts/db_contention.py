@@ -0,0 +1,165 @@
+"""Time the API's reads while transfers are writing to the database.
+
+Runs against a scratch database in a temporary directory. Writer threads
+update task progress and file rows in short transactions the way the task
+workers do, while the main thread times the queries behind GET /tasks/ and
+a storage device's file list, first on its own and then with the writers
+running, and prints the read latency of both.
+
+    poetry run python3 scripts/db_contention.py --writers 8 --seconds 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep
+
+scratch = tempfile.mkdtemp()
+os.environ["DATABASE_PATH"] = scratch + "/"
+os.environ.setdefault("LOCAL_BASE_PATH", scratch + "/")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crud  # noqa: E402
+import models  # noqa: E402
+import sqlalchemy as sa  # noqa: E402
+from database import SessionLocal, engine  # noqa: E402
+
+FILES = 5000
+TASKS = 2000
+
+
+def populate():
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    sd = models.StorageDevice(name="benchmark", base_path=scratch + "/")
+    session.add(sd)
+    session.flush()
+    sd_id = sd.id
+    session.add_all(
+        models.File(
+            storage_device_id=sd_id,
+            title="File {}".format(i),
+            remote_path="/media/file-{}.mkv".format(i),
+            rating_key=i,
+            file_size=1024 * 1024 * 1024,
+        )
+        for i in range(FILES)
+    )
+    session.add_all(
+        models.Task(
+            name="Transfer file {}".format(i),
+            func="transfer_file",
+            args=[i + 1],
+            kwargs={},
+            total=1024 * 1024 * 1024,
+            storage_device_id=sd_id,
+        )
+        for i in range(TASKS)
+    )
+    session.commit()
+    SessionLocal.remove()
+    return sd_id
+
+
+def write(index, stop, interval, counts):
+    # every commit is a transfer reporting its progress like flush_progress,
+    # then marking its file synced
+    session = SessionLocal()
+    task_id = index + 1
+    progress = 0
+    try:
+        while not stop.is_set():
+            progress += 1024 * 1024
+            session.execute(
+                sa.update(models.Task)
+                .where(models.Task.id == task_id)
+                .values(status=models.TaskStatus.RUNNING, progress=progress)
+            )
+            session.execute(
+                sa.update(models.File)
+                .where(models.File.id == task_id)
+                .values(status=models.FileStatus.SYNCED)
+            )
+            session.commit()
+            counts[index] += 1
+            sleep(interval)
+    finally:
+        SessionLocal.remove()
+
+
+def read(sd_id, seconds):
+    session = SessionLocal()
+    latencies = []
+    deadline = monotonic() + seconds
+    try:
+        while monotonic() < deadline:
+            started = monotonic()
+            crud.get_tasks(session, limit=100)
+            crud.get_files_for_storage_device(session, sd_id, limit=100)
+            session.commit()
+            latencies.append(monotonic() - started)
+    finally:
+        SessionLocal.remove()
+    return latencies
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+    print(
+        "{}: {} reads, p50 {:0.2f}ms, p95 {:0.2f}ms, p99 {:0.2f}ms, "
+        "max {:0.2f}ms".format(
+            label,
+            len(latencies),
+            percentile(0.5),
+            percentile(0.95),
+            percentile(0.99),
+            latencies[-1] * 1000,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    # seconds between a writer's commits
+    parser.add_argument("--interval", type=float, default=0.01)
+    options = parser.parse_args()
+
+    sd_id = populate()
+    with engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+    print("Database in {}, journal mode {}".format(scratch, journal_mode))
+
+    report("Idle", read(sd_id, options.seconds))
+
+    stop = threading.Event()
+    counts = [0] * options.writers
+    writers = [
+        threading.Thread(target=write, args=(i, stop, options.interval, counts))
+        for i in range(options.writers)
+    ]
+    for writer in writers:
+        writer.start()
+    try:
+        latencies = read(sd_id, options.seconds)
+    finally:
+        stop.set()
+        for writer in writers:
+            writer.join()
+    report("{} writers".format(options.writers), latencies)
+    print(
+        "Writers committed {} times ({:0.0f}/s)".format(
+            sum(counts), sum(counts) / options.seconds
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import logging
+import os
+import time
+
+from models import LOCAL_BASE_PATH
+from transfer import BUFFER_SIZE, copy_fd, get_partial_path, preallocate
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+# a directory on a fast local disk to keep copies of the files that are
+# about to be transferred in, so a transfer doesn't wait on a slow network
+# mount at LOCAL_BASE_PATH, disabled when unset
+STAGING_PATH = os.environ.get("STAGING_PATH")
+STAGING_SIZE = int(os.environ.get("STAGING_SIZE", 50 * 1024 * 1024 * 1024))
+# the scheduler's device key for copies to the staging cache
+STAGING_DEVICE = "staging"
+
+O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def get_staged_path(local_path):
+    if not STAGING_PATH or not local_path.startswith(LOCAL_BASE_PATH):
+        return None
+    return os.path.join(STAGING_PATH, os.path.relpath(local_path, LOCAL_BASE_PATH))
+
+
+def is_current(staged_path, stat):
+    """Whether a staged copy still matches the source's size and mtime."""
+    try:
+        staged = os.stat(staged_path)
+    except FileNotFoundError:
+        return False
+    return staged.st_size == stat.st_size and staged.st_mtime_ns == stat.st_mtime_ns
+
+
+def get_source_path(local_path):
+    """Return the staged copy of local_path if it's current, else local_path.
+
+    The staged copy's atime records when it was last used, its mtime is
+    kept the same as the source's.
+    """
+    staged_path = get_staged_path(local_path)
+    if staged_path is None:
+        return local_path
+    try:
+        stat = os.stat(local_path)
+    except OSError:
+        return local_path
+    if not is_current(staged_path, stat):
+        return local_path
+    os.utime(staged_path, ns=(time.time_ns(), stat.st_mtime_ns))
+    return staged_path
+
+
+def open_source(local_path, flags):
+    """Open the staged copy of local_path if it's current, else local_path.
+
+    Returns (fd, path). Once it's open the staged copy stays readable even
+    if make_room evicts it, and when it's evicted before it can be opened
+    local_path is opened instead.
+    """
+    source_path = get_source_path(local_path)
+    if source_path != local_path:
+        try:
+            return os.open(source_path, flags), source_path
+        except FileNotFoundError:
+            logger.info("{} was evicted from staging".format(source_path))
+    return os.open(local_path, flags), local_path
+
+
+def scan_staging():
+    """Return {path: (size, atime)} for everything in the staging cache."""
+    files = {}
+    for root, _, names in os.walk(STAGING_PATH):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[path] = (stat.st_size, stat.st_atime)
+    return files
+
+
+def get_rank(rank):
+    # files without a rank are the least wanted
+    return float("inf") if rank is None else rank
+
+
+def make_room(needed, rank, wanted):
+    """Evict staged files until needed more bytes fit in STAGING_SIZE.
+
+    wanted maps the staged paths of files still to be transferred to their
+    best File.rank. Files nobody wants go first, least recently used first,
+    then wanted ones from the worst rank, but only those ranked below rank.
+    Returns whether there is room.
+    """
+    files = scan_staging()
+    used = sum(size for size, _ in files.values())
+    for path in sorted(
+        files,
+        key=lambda path: (
+            path in wanted,
+            -get_rank(wanted.get(path)),
+            files[path][1],
+        ),
+    ):
+        if used + needed <= STAGING_SIZE:
+            break
+        if path in wanted and get_rank(wanted[path]) <= get_rank(rank):
+            break
+        os.remove(path)
+        used -= files[path][0]
+        logger.info("Evicted {} from staging".format(path))
+    return used + needed <= STAGING_SIZE
+
+
+def stage(local_path, stat, chunk_size=BUFFER_SIZE):
+    """Copy local_path to the staging cache, yielding the position after
+    every chunk. The copy only appears once it's complete."""
+    staged_path = get_staged_path(local_path)
+    partial_path = get_partial_path(staged_path)
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    file_in = os.open(local_path, os.O_RDONLY | O_BINARY)
+    try:
+        file_out = os.open(
+            partial_path, os.O_RDWR | os.O_CREAT | O_BINARY, stat.st_mode
+        )
+        try:
+            os.ftruncate(file_out, 0)
+            preallocate(file_out, 0, stat.st_size)
+            for position, _ in copy_fd(file_in, file_out, 0, stat.st_size, chunk_size):
+                yield position
+            os.fsync(file_out)
+        finally:
+            os.close(file_out)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        os.close(file_in)
+    os.utime(partial_path, ns=(time.time_ns(), stat.st_mtime_ns))
+    os.replace(partial_path, staged_path)
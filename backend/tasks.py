@@ -1,17 +1,77 @@
 import asyncio
+import itertools
 import logging
 import math
 import os
 import queue
 import threading
-from concurrent.futures import ThreadPoolExecutor
-from time import sleep
+from collections import Counter
+from datetime import timedelta
+from time import monotonic
 
 import database
 import sqlalchemy as sa
-from models import File, FileStatus, StorageDevice, Task, TaskStatus, get_local_path
-from plex_api import get_client
+from benchmark import benchmark_device, device_tuner
+from events import publish_created, task_events
+from eviction import plan_eviction
+from manifest import manifest_cache
+from models import (
+    LOCAL_BASE_PATH,
+    File,
+    FileStatus,
+    StorageDevice,
+    Task,
+    TaskStatus,
+    get_local_path,
+)
+from planner import (
+    RANK_EPISODES,
+    RANK_NEXT_UP,
+    RANK_ON_DECK,
+    RANK_PLAYLIST,
+    plan_transfers,
+)
+from plex_api import fetch_items, get_client
 from plexapi.exceptions import NotFound
+from progress import progress_registry, utcnow
+from scheduler import (
+    METADATA_LANE,
+    PRIORITY_BACKGROUND,
+    PRIORITY_SCHEDULED,
+    TRANSFER_LANE,
+    DeviceScheduler,
+)
+from sqlalchemy.dialects.sqlite import insert
+from staging import (
+    STAGING_DEVICE,
+    STAGING_PATH,
+    STAGING_SIZE,
+    get_staged_path,
+    is_current,
+    make_room,
+    open_source,
+    stage,
+)
+from throttle import bandwidth_limiter
+from transfer import (
+    BUFFER_SIZE,
+    CACHE_MODE,
+    CHECKPOINT_INTERVAL,
+    DROP_INTERVAL,
+    FanOutCopy,
+    StreamHasher,
+    advise,
+    copy_fd,
+    drop_cache,
+    get_checkpoint_path,
+    get_page_cache,
+    get_partial_path,
+    get_resume_offset,
+    preallocate,
+    remove_checkpoint,
+    verify_checksum,
+    write_checkpoint,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -21,7 +81,30 @@ log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 stream_handler.setFormatter(logging.Formatter(log_format))
 logger.addHandler(stream_handler)
 
-MAX_WORKERS = 10
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 10))
+MAX_METADATA_WORKERS = int(os.environ.get("MAX_METADATA_WORKERS", 2))
+MAX_TRANSFERS_PER_DEVICE = int(os.environ.get("MAX_TRANSFERS_PER_DEVICE", 1))
+MAX_TRANSFERS_PER_SOURCE = int(os.environ.get("MAX_TRANSFERS_PER_SOURCE", 2))
+# most other devices a transfer_file copies its file to from the same read
+MAX_FANOUT_TARGETS = int(os.environ.get("MAX_FANOUT_TARGETS", 4))
+
+# File rows written per commit by get_files and check_files
+FILE_BATCH_SIZE = int(os.environ.get("FILE_BATCH_SIZE", 500))
+# hours between the full scans get_files does instead of an incremental sync
+FULL_SYNC_INTERVAL = float(os.environ.get("FULL_SYNC_INTERVAL", 24))
+
+# tasks that bulk copy data and are scheduled per storage device
+TRANSFER_FUNCS = {"transfer_file"}
+# tasks whose first argument is a storage device id
+DEVICE_FUNCS = {
+    "benchmark_sd",
+    "get_files",
+    "check_files",
+    "sync_items",
+    "transfer_files",
+    "transfer_some_files",
+    "eject_sd",
+}
 
 
 try:
@@ -29,76 +112,158 @@ try:
 except:
     O_BINARY = 0
 READ_FLAGS = os.O_RDONLY | O_BINARY
-WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY
-BUFFER_SIZE = 1024 * 1024 * 10  # 10MB
+# the target is read back and not truncated so interrupted transfers can resume
+WRITE_FLAGS = os.O_RDWR | os.O_CREAT | O_BINARY
 
 
-# Task queue using a thread-safe queue
-task_queue = queue.Queue()
+# Task queue using a thread-safe priority queue of
+# (priority, seq, task_id, enqueued), seq keeps it FIFO within a priority
+task_queue = queue.PriorityQueue()
+task_counter = itertools.count()
+shutdown_event = threading.Event()
+stopped_event = threading.Event()
+scheduler = None
+# bytes copied by each copy_fd method since the process started
+copy_methods = Counter()
+copy_methods_lock = threading.Lock()
 
 
 # Function to add a task to the queue
-def add_task_to_queue(task_id):
-    task_queue.put(task_id)
+def add_task_to_queue(task_id, priority=PRIORITY_SCHEDULED):
+    task_queue.put((priority, next(task_counter), task_id, monotonic()))
+
+
+def flush_progress(session, task_id):
+    values = progress_registry.flushed(task_id)
+    if values is None:
+        return
+    if values["status"] in (TaskStatus.SUCCESS, TaskStatus.FAILED):
+        values["finished"] = sa.func.now()
+    session.execute(sa.update(Task).where(Task.id == task_id).values(**values))
+    session.commit()
+
+
+def claim_task(session, task_id):
+    """Mark a pending task as running, returning False if it isn't pending."""
+    claimed = session.execute(
+        sa.update(Task)
+        .where(Task.id == task_id, Task.status == TaskStatus.PENDING)
+        .values(status=TaskStatus.RUNNING, progress=0, started=sa.func.now())
+    ).rowcount
+    session.commit()
+    return claimed == 1
 
 
 def worker(task_id):
     logger.info("Worker started for task {}".format(task_id))
     with database.SessionLocal() as session:
+        # plain values rather than the Task, so nothing is loaded again and
+        # no transaction is left open while the task runs
         task = session.execute(
-            sa.select(Task).where(Task.id == task_id)
-        ).scalar_one_or_none()
+            sa.select(Task.name, Task.func, Task.args, Task.kwargs, Task.total).where(
+                Task.id == task_id
+            )
+        ).one_or_none()
         if task is None:
             logger.warning("Task {} not found".format(task_id))
-            task_queue.task_done()
+            return
+        # stopped while it was waiting, or already run by another task, e.g.
+        # a transfer_file that fanned out to it
+        if not claim_task(session, task_id):
+            logger.info("Skipping task {} as it's not pending".format(task.name))
+            return
         logger.info("Starting task {}".format(task.name))
-        task.progress = 0
-        task.status = TaskStatus.RUNNING
-        task.started = sa.func.now()
+        name = task.name
+        func_name = task.func
         args = task.args
-        session.commit()
+        kwargs = task.kwargs or {}
+        progress_registry.start(task_id, total=task.total)
         logger.debug("Task args: {}".format(args))
         try:
-            func = globals().get(task.func)
+            func = globals().get(func_name)
             if func is not None and callable(func):
-                for progress, increment, total, status in func(*args):
-                    if task.status == TaskStatus.STOPPED:
-                        logger.info("Task {} stopped".format(task.name))
+                for progress, increment, total, status in func(*args, **kwargs):
+                    if shutdown_event.is_set():
+                        # picked up again when the queue next starts
+                        logger.info("Task {} interrupted".format(name))
+                        progress_registry.update(task_id, status=TaskStatus.PENDING)
                         break
-                    if progress:
-                        task.progress = progress
-                    elif increment:
-                        task.progress += increment
-                    if total:
-                        task.total = total
-                    task.status = status
-                    if status == TaskStatus.SUCCESS:
-                        task.finished = sa.func.now()
-                    session.commit()
+                    if progress_registry.is_stopped(task_id):
+                        logger.info("Task {} stopped".format(name))
+                        break
+                    progress_registry.update(
+                        task_id, progress, increment, total, status
+                    )
+                    if progress_registry.should_flush(task_id):
+                        flush_progress(session, task_id)
             else:
-                logger.warning("Unknown function {}".format(task.func))
+                logger.warning("Unknown function {}".format(func_name))
         except Exception as e:
-            logger.error("Task failed {}".format(task.name))
+            logger.error("Task failed {}".format(name))
             logger.exception(e)
-            if task is None:
-                logger.warning("Task {} not found".format(task_id))
-                task_queue.task_done()
-            task.finished = sa.func.now()
-            task.status = TaskStatus.FAILED
-            session.commit()
-            task_queue.task_done()
+            session.rollback()
+            progress_registry.update(task_id, status=TaskStatus.FAILED)
+        finally:
+            flush_progress(session, task_id)
+            progress_registry.remove(task_id)
+
+
+def get_source_volume(path):
+    try:
+        return os.stat(os.path.dirname(path)).st_dev
+    except OSError:
+        return None
+
+
+def get_task_storage_device_id(session, func, args):
+    if not args:
+        return None
+    if func in DEVICE_FUNCS:
+        return args[0]
+    if func in TRANSFER_FUNCS:
+        file = session.get(File, args[0])
+        if file is not None:
+            return file.storage_device_id
+    return None
+
+
+def get_task_route(session, task_id):
+    """Return the (lane, storage device id, source volume) to run a task on."""
+    task = session.get(Task, task_id)
+    if task is not None and task.func == "prefetch_files":
+        # bulk copies from the source too, to the staging cache
+        return TRANSFER_LANE, STAGING_DEVICE, get_source_volume(LOCAL_BASE_PATH)
+    if task is None or task.func not in TRANSFER_FUNCS:
+        return METADATA_LANE, None, None
+    file = session.get(File, task.args[0])
+    if file is None:
+        return METADATA_LANE, None, None
+    return TRANSFER_LANE, file.storage_device_id, get_source_volume(file.local_path)
 
 
 # Function to retrieve and process tasks from the queue
 def process_task_queue():
     logger.info("Fixing Old Tasks")
     with database.SessionLocal() as session:
+        # listed rather than != SUCCESS so ix_task_status_created is used
+        # instead of scanning every finished task
         session.execute(
             sa.update(Task)
-            .where(Task.status != TaskStatus.SUCCESS)
+            .where(
+                Task.status.in_(
+                    [
+                        TaskStatus.PENDING,
+                        TaskStatus.RUNNING,
+                        TaskStatus.FAILED,
+                        TaskStatus.STOPPED,
+                    ]
+                )
+            )
             .values(status=TaskStatus.PENDING, progress=0)
         )
         session.commit()
+        # none of those were published, clients have to reload their tasks
+        task_events.reset()
         # add pending tasks to queue
         tasks = (
             session.execute(sa.select(Task).where(Task.status == TaskStatus.PENDING))
@@ -106,99 +271,427 @@ def process_task_queue():
             .all()
         )
         for task in tasks:
-            add_task_to_queue(task.id)
+            if task.func in TRANSFER_FUNCS:
+                add_task_to_queue(task.id, PRIORITY_BACKGROUND)
+            else:
+                add_task_to_queue(task.id, PRIORITY_SCHEDULED)
             logger.info("Added task {} to queue".format(task.name))
     logger.info("Starting Task Queue")
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        while True and threading.main_thread().is_alive():
+    global scheduler
+    scheduler = DeviceScheduler(
+        worker,
+        max_metadata_workers=MAX_METADATA_WORKERS,
+        max_transfer_workers=MAX_WORKERS,
+        max_per_device=MAX_TRANSFERS_PER_DEVICE,
+        max_per_source=MAX_TRANSFERS_PER_SOURCE,
+    )
+    with database.SessionLocal() as session:
+        # per device limits found by benchmark_sd and the tuning since
+        for sd_id, max_transfers in session.execute(
+            sa.select(StorageDevice.id, StorageDevice.max_transfers).where(
+                StorageDevice.max_transfers.is_not(None)
+            )
+        ):
+            scheduler.set_device_limit(sd_id, max_transfers)
+    try:
+        while not shutdown_event.is_set():
+            # blocks until a task is queued or stop_task_queue wakes us up
+            priority, _, task_id, enqueued = task_queue.get()
             try:
-                task_id = task_queue.get(block=False)
-                logger.info("Starting task {}".format(task_id))
-                executor.submit(worker, task_id)
-                logger.info("Task {} submitted".format(task_id))
-            except queue.Empty:
-                # logger.debug("Queue is empty")
-                sleep(0.1)
-            except KeyboardInterrupt:
-                logger.info("Stopping task queue")
-                executor.shutdown(wait=False)
-                return
+                if task_id is None:
+                    continue
+                with database.SessionLocal() as session:
+                    lane, device, source = get_task_route(session, task_id)
+                scheduler.submit(task_id, lane, device, source, priority, enqueued)
+                logger.info("Task {} submitted to {} lane".format(task_id, lane))
             except Exception as e:
-                logger.error("Task failed")
+                logger.error("Unable to schedule task {}".format(task_id))
                 logger.exception(e)
-                sleep(1)
+            finally:
+                task_queue.task_done()
+    finally:
+        logger.info("Stopping task queue")
+        scheduler.shutdown(wait=True)
+        stopped_event.set()
+
+
+# Stop the task queue, running tasks stop at their next progress update
+def stop_task_queue(timeout=30):
+    shutdown_event.set()
+    task_queue.put((-1, next(task_counter), None, monotonic()))
+    if not stopped_event.wait(timeout):
+        logger.warning("Task queue did not stop within {}s".format(timeout))
+
+
+def get_queue_metrics():
+    if scheduler is None:
+        metrics = {
+            "started": 0,
+            "pending": task_queue.qsize(),
+            "running": 0,
+            "latency": None,
+        }
+    else:
+        metrics = scheduler.metrics()
+    # to see how much of the cache transfers take up, see CACHE_MODE
+    metrics["page_cache"] = get_page_cache()
+    with copy_methods_lock:
+        metrics["copy_methods"] = dict(copy_methods)
+    return metrics
+
+
+def record_copy_methods(methods):
+    with copy_methods_lock:
+        copy_methods.update(methods)
+
+
+def get_episode_position(episode):
+    return (episode.parentIndex or 0, episode.index or 0)
+
+
+def has_changed(item, file):
+    """Whether a Plex item has changed since its File row was last synced."""
+    return (
+        file is None
+        or file.updated_at is None
+        or item.updatedAt != file.updated_at
+        or item.lastViewedAt != file.last_viewed_at
+        or item.media[0].parts[0].file != file.remote_path
+    )
+
+
+def add_candidate(candidates, item, rank):
+    # an item from more than one source keeps its best rank
+    if item.ratingKey not in candidates or rank < candidates[item.ratingKey][1]:
+        candidates[item.ratingKey] = (item, rank)
+
+
+def get_candidates(plex_client, sd, existing=None):
+    """Return the (item, rank) pairs to sync to a storage device, without
+    duplicates, and the updatedAt of the sync playlist.
+
+    The rank orders the items for the planner, see planner.RANK_NEXT_UP.
+    With sync_all_episodes every unplayed episode after an episode that is
+    already a candidate is added too, each show's episodes are only fetched
+    once. Passing the existing File rows (rating key -> row) only looks for
+    changes: the sync playlist is skipped when it hasn't been updated since
+    the last sync and only shows with a new or changed candidate are fetched.
+    """
+    candidates = dict()
+    sources = []
+    if sd.sync_on_deck:
+        sources.append((plex_client.library.onDeck(), RANK_NEXT_UP))
+    if sd.sync_continue_watching:
+        sources.append((plex_client.continueWatching(), RANK_NEXT_UP))
+    playlist_updated_at = None
+    if sd.sync_playlist:
+        playlist = plex_client.playlist(sd.sync_playlist)
+        playlist_updated_at = playlist.updatedAt
+        if (
+            existing is None
+            or sd.playlist_updated_at is None
+            or playlist.updatedAt != sd.playlist_updated_at
+        ):
+            sources.append((playlist.items(), RANK_PLAYLIST))
+        else:
+            logger.info("Skipping {} as it's unchanged".format(sd.sync_playlist))
+    for items, rank in sources:
+        for item in items:
+            if rank == RANK_NEXT_UP and item.type != "episode":
+                add_candidate(candidates, item, RANK_ON_DECK)
+            else:
+                add_candidate(candidates, item, rank)
+    if sd.sync_all_episodes:
+        # show rating key -> (position of its earliest candidate, episodes)
+        shows = dict()
+        for item, _ in candidates.values():
+            if item.type != "episode":
+                continue
+            if existing is not None and not has_changed(
+                item, existing.get(item.ratingKey)
+            ):
+                continue
+            position = get_episode_position(item)
+            earliest = shows.get(item.grandparentRatingKey)
+            if earliest is None or position < earliest[0]:
+                shows[item.grandparentRatingKey] = (position, item)
+        for position, item in shows.values():
+            episodes = [
+                episode
+                for episode in item.show().episodes(played=False)
+                if get_episode_position(episode) > position
+            ]
+            # the sooner an episode comes up the higher it's ranked
+            for offset, episode in enumerate(episodes):
+                add_candidate(candidates, episode, RANK_EPISODES + offset)
+    return list(candidates.values()), playlist_updated_at
+
+
+def get_title(item):
+    if item.type == "episode":
+        return "{series} | {season_episode} | {title}".format(
+            series=item.grandparentTitle,
+            season_episode=item.seasonEpisode,
+            title=item.title,
+        )
+    return item.title
+
+
+def upsert_files(session, rows, missing):
+    """Insert or update a batch of File rows and mark missing ones in one commit."""
+    if rows:
+        statement = insert(File).values(rows)
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[File.storage_device_id, File.rating_key],
+                set_={
+                    "remote_path": statement.excluded.remote_path,
+                    "file_size": statement.excluded.file_size,
+                    "updated_at": statement.excluded.updated_at,
+                    "last_viewed_at": statement.excluded.last_viewed_at,
+                    "source_mtime": statement.excluded.source_mtime,
+                    "rank": statement.excluded.rank,
+                    # the copy on the device no longer matches a changed source
+                    "checksum": sa.case(
+                        (
+                            sa.and_(
+                                File.file_size == statement.excluded.file_size,
+                                File.source_mtime == statement.excluded.source_mtime,
+                            ),
+                            File.checksum,
+                        ),
+                        else_=None,
+                    ),
+                },
+            )
+        )
+    if missing:
+        session.execute(
+            sa.update(File)
+            .where(File.id.in_(missing))
+            .values(status=FileStatus.MISSING)
+        )
+    session.commit()
+    rows.clear()
+    missing.clear()
+
+
+def save_file_changes(session, changes, deleted):
+    """Write a batch of File updates and deletes in one commit."""
+    if changes:
+        session.execute(sa.update(File), changes)
+    if deleted:
+        session.execute(sa.delete(File).where(File.id.in_(deleted)))
+    session.commit()
+    changes.clear()
+    deleted.clear()
 
 
-# Stop the task queue
-def stop_task_queue():
-    task_queue.join()
+def get_source_stat(item, file, full=False):
+    """Return the (size, mtime) of an item's source file.
 
+    The values stored for the file are reused while its path and Plex's
+    updatedAt are the same, so only files Plex has seen change are stat'd.
+    """
+    remote_path = item.media[0].parts[0].file
+    if (
+        not full
+        and file is not None
+        and file.source_mtime is not None
+        and file.remote_path == remote_path
+        and file.updated_at == item.updatedAt
+    ):
+        return file.file_size, file.source_mtime
+    stat = os.stat(get_local_path(remote_path))
+    return stat.st_size, stat.st_mtime
 
-def get_files(sd_id):
+
+def needs_full_sync(sd):
+    if sd.last_full_sync is None:
+        return True
+    return utcnow() - sd.last_full_sync >= timedelta(hours=FULL_SYNC_INTERVAL)
+
+
+def get_files(sd_id, full=False):
+    """Add the items to sync to a storage device's files.
+
+    Unless full is set, or the last full scan was more than FULL_SYNC_INTERVAL
+    hours ago, only items Plex has updated or that have been viewed since the
+    last sync are processed. Their source files are only stat'd again when
+    Plex reports a change, otherwise the size stored for the path is used.
+    """
     plex_client = get_client()
     logger.info("Getting files for {}".format(sd_id))
     with database.SessionLocal() as session:
         sd = session.execute(
             sa.select(StorageDevice).where(StorageDevice.id == sd_id)
         ).scalar_one_or_none()
-        to_download = list()
-        if sd.sync_on_deck:
-            to_download.extend(plex_client.library.onDeck())
-        if sd.sync_continue_watching:
-            to_download.extend(plex_client.continueWatching())
-        if sd.sync_playlist:
-            to_download.extend(plex_client.playlist(sd.sync_playlist).items())
+        full = full or needs_full_sync(sd)
+        started = utcnow()
+        existing = {
+            file.rating_key: file
+            for file in session.execute(
+                sa.select(
+                    File.id,
+                    File.rating_key,
+                    File.status,
+                    File.remote_path,
+                    File.file_size,
+                    File.updated_at,
+                    File.last_viewed_at,
+                    File.source_mtime,
+                    File.rank,
+                ).where(File.storage_device_id == sd.id)
+            )
+        }
+        to_download, playlist_updated_at = get_candidates(
+            plex_client, sd, None if full else existing
+        )
+        manifest = None
         session.commit()
-        for item in to_download:
-            rating_key = item.ratingKey
-            file = session.execute(
-                sa.select(File).where(
-                    File.storage_device_id == sd.id, File.rating_key == rating_key
-                )
-            ).scalar_one_or_none()
+        logger.info(
+            "{} sync of {} candidates".format(
+                "Full" if full else "Incremental", len(to_download)
+            )
+        )
+        yield 0, 0, len(to_download), TaskStatus.RUNNING
+        rows = []
+        missing = []
+        unchanged = 0
+        for item, rank in to_download:
+            remote_path = item.media[0].parts[0].file
+            file = existing.get(item.ratingKey)
             if file is None:
-                local_path = get_local_path(item.media[0].parts[0].file)
-                if item.type == "episode":
-                    title = "{series} | {season_episode} | {title}".format(
-                        series=item.grandparentTitle,
-                        season_episode=item.seasonEpisode,
-                        title=item.title,
-                    )
-                else:
-                    title = item.title
-                file = File(
-                    title=title,
-                    rating_key=item.ratingKey,
-                    remote_path=item.media[0].parts[0].file,
-                    storage_device_id=sd.id,
-                    file_size=os.path.getsize(local_path),
-                )
-                session.add(file)
-                session.commit()
                 logger.info("File added for {}".format(item.title))
+            elif file.status == FileStatus.WATCHED and not item.isPlayed:
+                if manifest is None:
+                    manifest = manifest_cache.get(sd)
+                if not manifest.exists(sd.get_drive_path(remote_path)):
+                    missing.append(file.id)
+            changed = has_changed(item, file)
+            if full or changed:
+                file_size, source_mtime = get_source_stat(item, file, full)
             else:
-                logger.info("File already exists for {}".format(item.title))
-                file.remote_path = item.media[0].parts[0].file
-                file.file_size = os.path.getsize(file.local_path)
-                session.commit()
-                if (
-                    file.status == FileStatus.WATCHED
-                    and not item.isPlayed
-                    and not os.path.exists(file.storage_path)
-                ):
-                    file.status = FileStatus.MISSING
-                    session.commit()
-            if item.type == "episode" and sd.sync_all_episodes:
-                for episode in item.show().episodes(played=False):
-                    if (
-                        episode.seasonEpisode > item.seasonEpisode
-                        and to_download.count(episode) == 0
-                    ):
-                        to_download.append(episode)
-            yield None, 1, len(to_download), TaskStatus.RUNNING
+                file_size, source_mtime = file.file_size, file.source_mtime
+            if (
+                changed
+                or file_size != file.file_size
+                or source_mtime != file.source_mtime
+                or rank != file.rank
+            ):
+                rows.append(
+                    {
+                        "title": get_title(item),
+                        "rating_key": item.ratingKey,
+                        "remote_path": remote_path,
+                        "storage_device_id": sd.id,
+                        "file_size": file_size,
+                        "status": FileStatus.MISSING,
+                        "updated_at": item.updatedAt,
+                        "last_viewed_at": item.lastViewedAt,
+                        "source_mtime": source_mtime,
+                        "rank": rank,
+                    }
+                )
+            else:
+                unchanged += 1
+            if len(rows) + len(missing) >= FILE_BATCH_SIZE:
+                upsert_files(session, rows, missing)
+            yield None, 1, None, TaskStatus.RUNNING
+        upsert_files(session, rows, missing)
+        values = {"playlist_updated_at": playlist_updated_at}
+        if full:
+            values["last_full_sync"] = started
+        session.execute(
+            sa.update(StorageDevice).where(StorageDevice.id == sd.id).values(**values)
+        )
+        session.commit()
+        logger.info("{} files unchanged for {}".format(unchanged, sd.name))
+        queue_prefetch(session)
         yield None, 0, None, TaskStatus.SUCCESS
 
 
+def queue_prefetch(session):
+    """Queue prefetch_files unless staging is off or it's already queued."""
+    if not STAGING_PATH:
+        return
+    queued = session.execute(
+        sa.select(Task.id).where(
+            Task.func == "prefetch_files",
+            Task.status.in_([TaskStatus.PENDING, TaskStatus.RUNNING]),
+        )
+    ).first()
+    if queued is not None:
+        return
+    task = Task(
+        name="Prefetch files to staging",
+        func="prefetch_files",
+        args=[],
+        kwargs={},
+    )
+    session.add(task)
+    session.commit()
+    publish_created(task)
+    add_task_to_queue(task.id, PRIORITY_BACKGROUND)
+
+
+def prefetch_files():
+    """Copy the missing files of every storage device to the staging cache,
+    best ranked first, so their transfers don't read the source.
+
+    Stops once the cache is full of files ranked at least as well as the
+    next one, see staging.make_room.
+    """
+    if not STAGING_PATH:
+        yield 0, None, 0, TaskStatus.SUCCESS
+        return
+    with database.SessionLocal() as session:
+        rows = session.execute(
+            sa.select(File.remote_path, sa.func.min(File.rank).label("rank"))
+            .where(File.status == FileStatus.MISSING)
+            .group_by(File.remote_path)
+        ).all()
+    rows = sorted(rows, key=lambda row: (row.rank is None, row.rank or 0))
+    wanted = {
+        get_staged_path(get_local_path(row.remote_path)): row.rank for row in rows
+    }
+    yield 0, None, len(rows), TaskStatus.RUNNING
+    for row in rows:
+        local_path = get_local_path(row.remote_path)
+        staged_path = get_staged_path(local_path)
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            logger.error(
+                "Unable to prefetch {} as it can't be found".format(local_path)
+            )
+            yield None, 1, None, TaskStatus.RUNNING
+            continue
+        if is_current(staged_path, stat) or stat.st_size > STAGING_SIZE:
+            yield None, 1, None, TaskStatus.RUNNING
+            continue
+        if os.path.exists(staged_path):
+            # the source has changed since
+            os.remove(staged_path)
+        if not make_room(stat.st_size, row.rank, wanted):
+            logger.info("Staging is full, stopping at {}".format(local_path))
+            break
+        logger.info("Prefetching {}".format(local_path))
+        copied = 0
+        copy = stage(local_path, stat)
+        for position in copy:
+            delay = bandwidth_limiter.throttle_source(local_path, position - copied)
+            copied = position
+            if delay:
+                shutdown_event.wait(delay)
+            if shutdown_event.is_set():
+                # deletes the partial copy, the rest is prefetched next time
+                copy.close()
+                return
+        yield None, 1, None, TaskStatus.RUNNING
+    yield None, None, None, TaskStatus.SUCCESS
+
+
 def remove_empty_folders(path):
     walk = list(os.walk(path))
     for path, _, _ in walk[::-1]:
@@ -206,85 +699,518 @@ def remove_empty_folders(path):
             os.rmdir(path)
 
 
-def check_files(sd_id):
+def check_file(plex_client, sd, manifest, file, item, verify=False):
+    """Work out a file's new title and status from its Plex item, removing it
+    from the storage device once played. With verify the copy on the device
+    is also compared to the checksum recorded when it was transferred.
+
+    Returns (title, status, deleted), deleted is set when the item is gone
+    from Plex and the row should be removed too.
+    """
+    storage_path = sd.get_drive_path(file.remote_path)
+    title = file.title
+    status = file.status
+    try:
+        if item is None:
+            raise NotFound("{} not found".format(file.rating_key))
+        if item.type == "episode":
+            title = get_title(item)
+        if manifest.exists(storage_path):
+            if item.isPlayed:
+                logger.info("Removing '{}' as it's been played".format(title))
+                manifest.discard(storage_path)
+                status = FileStatus.WATCHED
+            else:
+                if manifest.getsize(storage_path) != file.file_size:
+                    logger.info("Removing '{}' as it's been changed".format(title))
+                    manifest.discard(storage_path)
+                    status = FileStatus.MISSING
+                elif (
+                    verify
+                    and file.checksum
+                    and not verify_checksum(storage_path, file.checksum)
+                ):
+                    logger.info("Removing '{}' as it's corrupted".format(title))
+                    manifest.discard(storage_path)
+                    status = FileStatus.MISSING
+                else:
+                    logger.info("Keeping '{}' as it's not been played".format(title))
+                    if status != FileStatus.IGNORED:
+                        status = FileStatus.SYNCED
+        else:
+            if item.isPlayed:
+                logger.info("Marking '{}' as played".format(title))
+                item.markPlayed()
+                status = FileStatus.WATCHED
+                try:
+                    plex_client.playlist(sd.sync_playlist).removeItems([item])
+                except NotFound:
+                    pass
+            else:
+                logger.info("Adding '{}' as it's missing been played".format(title))
+                status = FileStatus.MISSING
+    except NotFound:
+        logger.info("Removing '{}' as it's been deleted".format(title))
+        try:
+            manifest.remove(storage_path)
+            status = FileStatus.WATCHED
+        except FileNotFoundError:
+            logger.info("{} is not present on the disk".format(storage_path))
+            return title, status, True
+    return title, status, False
+
+
+def select_files(*where):
+    # plain rows so saving a batch doesn't expire and reload every file
+    return sa.select(
+        File.id,
+        File.rating_key,
+        File.title,
+        File.remote_path,
+        File.file_size,
+        File.status,
+        File.checksum,
+    ).where(*where)
+
+
+def check_files(sd_id, verify=False):
     plex_client = get_client()
     with database.SessionLocal() as session:
         sd = session.execute(
             sa.select(StorageDevice).where(StorageDevice.id == sd_id)
         ).scalar_one_or_none()
-        files = (
-            session.execute(
-                sa.select(File).where(
-                    File.storage_device_id == sd.id
-                    and File.status != FileStatus.MISSING
-                )
-            )
-            .scalars()
-            .all()
-        )
+        files = session.execute(select_files(File.storage_device_id == sd.id)).all()
         yield 0, 0, len(files), TaskStatus.RUNNING
+        # checking is when files changed behind GatoSnap's back get noticed
+        manifest = manifest_cache.get(sd, refresh=True)
+        items = fetch_items(plex_client, [file.rating_key for file in files])
+        changes = []
+        deleted = []
         for file in files:
-            try:
-                item = plex_client.library.fetchItem(file.rating_key)
-                if item.type == "episode":
-                    file.title = "{series} | {season_episode} | {title}".format(
-                        series=item.grandparentTitle,
-                        season_episode=item.seasonEpisode,
-                        title=item.title,
-                    )
-                session.commit()
-                if os.path.exists(file.storage_path):
-                    if item.isPlayed:
-                        logger.info(
-                            "Removing '{}' as it's been played".format(file.title)
-                        )
-                        os.remove(file.storage_path)
-                        file.status = FileStatus.WATCHED
-                    else:
-                        if os.path.getsize(file.storage_path) != file.file_size:
-                            logger.info(
-                                "Removing '{}' as it's been changed".format(file.title)
-                            )
-                            os.remove(file.storage_path)
-                            file.status = FileStatus.MISSING
-                        else:
-                            logger.info(
-                                "Keeping '{}' as it's not been played".format(
-                                    file.title
-                                )
-                            )
-                            if file.status != FileStatus.IGNORED:
-                                file.status = FileStatus.SYNCED
-                else:
-                    if item.isPlayed:
-                        logger.info("Marking '{}' as played".format(file.title))
-                        item.markPlayed()
-                        file.status = FileStatus.WATCHED
-                        try:
-                            plex_client.playlist(sd.sync_playlist).removeItems([item])
-                        except NotFound:
-                            pass
-                    else:
-                        logger.info(
-                            "Adding '{}' as it's missing been played".format(file.title)
-                        )
-                        file.status = FileStatus.MISSING
-            except NotFound:
-                logger.info("Removing '{}' as it's been deleted".format(file.title))
-                try:
-                    os.remove(file.storage_path)
-                    file.status = FileStatus.WATCHED
-                except FileNotFoundError:
-                    logger.info(
-                        "{} is not present on the disk".format(file.storage_path)
-                    )
-                    session.delete(file)
+            title, status, delete = check_file(
+                plex_client, sd, manifest, file, items.get(file.rating_key), verify
+            )
+            if delete:
+                deleted.append(file.id)
+            elif title != file.title or status != file.status:
+                changes.append({"id": file.id, "title": title, "status": status})
+            if len(changes) + len(deleted) >= FILE_BATCH_SIZE:
+                save_file_changes(session, changes, deleted)
             yield None, 1, None, TaskStatus.RUNNING
-            session.commit()
+        save_file_changes(session, changes, deleted)
         remove_empty_folders(sd.base_path)
         yield None, None, None, TaskStatus.SUCCESS
 
 
+def get_new_episodes(plex_client, session, sd, items):
+    """Return the newly added episodes that belong on a storage device.
+
+    An episode does when the device syncs all episodes and already holds its
+    show's next episode to watch.
+    """
+    if not sd.sync_all_episodes:
+        return []
+    episodes = [item for item in items if item.type == "episode" and not item.isPlayed]
+    if not episodes:
+        return []
+    # show rating key -> its on deck episode
+    next_up = {}
+    for episode in episodes:
+        if episode.grandparentRatingKey not in next_up:
+            next_up[episode.grandparentRatingKey] = episode.show().onDeck()
+    synced = set(
+        session.execute(
+            sa.select(File.rating_key).where(
+                File.storage_device_id == sd.id,
+                File.rating_key.in_(
+                    [item.ratingKey for item in next_up.values() if item is not None]
+                ),
+            )
+        ).scalars()
+    )
+    return [
+        episode
+        for episode in episodes
+        if next_up[episode.grandparentRatingKey] is not None
+        and next_up[episode.grandparentRatingKey].ratingKey in synced
+        and get_episode_position(episode)
+        > get_episode_position(next_up[episode.grandparentRatingKey])
+    ]
+
+
+def sync_items(sd_id, rating_keys):
+    """Bring a storage device up to date for a few changed Plex items.
+
+    Used by the Plex listener instead of a full get_files and check_files:
+    played items are removed from the device, items that need copying again
+    and newly added episodes are transferred.
+    """
+    plex_client = get_client()
+    with database.SessionLocal() as session:
+        sd = session.execute(
+            sa.select(StorageDevice).where(StorageDevice.id == sd_id)
+        ).scalar_one_or_none()
+        if not sd.connected:
+            # check_files catches up once it's plugged back in
+            logger.info("Skipping changes for {} as it's not connected".format(sd.name))
+            yield 0, 0, 0, TaskStatus.SUCCESS
+            return
+        files = session.execute(
+            select_files(
+                File.storage_device_id == sd.id, File.rating_key.in_(rating_keys)
+            )
+        ).all()
+        yield 0, 0, len(rating_keys), TaskStatus.RUNNING
+        items = fetch_items(plex_client, rating_keys)
+        # files removed from the device by hand since the last scan would
+        # be removed again
+        manifest = manifest_cache.get(sd, refresh=True)
+        changes = []
+        deleted = []
+        missing = []
+        for file in files:
+            title, status, delete = check_file(
+                plex_client, sd, manifest, file, items.pop(file.rating_key, None)
+            )
+            if delete:
+                deleted.append(file.id)
+            else:
+                if title != file.title or status != file.status:
+                    changes.append({"id": file.id, "title": title, "status": status})
+                if status == FileStatus.MISSING:
+                    missing.append(file.id)
+            yield None, 1, None, TaskStatus.RUNNING
+        save_file_changes(session, changes, deleted)
+        # whatever is left wasn't on the device yet
+        rows = []
+        for item in get_new_episodes(plex_client, session, sd, items.values()):
+            logger.info("File added for {}".format(item.title))
+            file_size, source_mtime = get_source_stat(item, None)
+            rows.append(
+                {
+                    "title": get_title(item),
+                    "rating_key": item.ratingKey,
+                    "remote_path": item.media[0].parts[0].file,
+                    "storage_device_id": sd.id,
+                    "file_size": file_size,
+                    "status": FileStatus.MISSING,
+                    "updated_at": item.updatedAt,
+                    "last_viewed_at": item.lastViewedAt,
+                    "source_mtime": source_mtime,
+                    # after the show's next up, exactly where isn't known here
+                    "rank": RANK_EPISODES,
+                }
+            )
+        keys = [row["rating_key"] for row in rows]
+        upsert_files(session, rows, [])
+        if keys:
+            missing += session.execute(
+                sa.select(File.id).where(
+                    File.storage_device_id == sd.id, File.rating_key.in_(keys)
+                )
+            ).scalars()
+        if missing:
+            task = Task(
+                name="Transfer {} changed files to {}".format(len(missing), sd.name),
+                func="transfer_some_files",
+                args=[sd.id, missing],
+                kwargs={},
+                storage_device_id=sd.id,
+            )
+            session.add(task)
+            session.commit()
+            publish_created(task)
+            add_task_to_queue(task.id, PRIORITY_BACKGROUND)
+        yield None, len(rating_keys) - len(files), None, TaskStatus.SUCCESS
+
+
+def apply_tuning(sd, changes):
+    # columns from benchmark_device or device_tuner, the caller commits
+    for key, value in changes.items():
+        setattr(sd, key, value)
+    if "max_transfers" in changes and scheduler is not None:
+        scheduler.set_device_limit(sd.id, changes["max_transfers"])
+
+
+def run_benchmark(session, sd):
+    # transfers running at the same time would skew the measurements, and
+    # none are started on the device until it's done
+    if scheduler is not None and not scheduler.acquire(sd.id, exclusive=True):
+        logger.info("Not benchmarking {} while it's transferring".format(sd.name))
+        return False
+    try:
+        changes, levels = benchmark_device(sd.base_path)
+    except OSError as e:
+        logger.error("Unable to benchmark {}".format(sd.name))
+        logger.exception(e)
+        return False
+    finally:
+        if scheduler is not None:
+            scheduler.release(sd.id)
+    device_tuner.seed(sd.id, levels)
+    apply_tuning(sd, changes)
+    sd.benchmarked_at = utcnow()
+    session.commit()
+    return True
+
+
+def benchmark_sd(sd_id):
+    with database.SessionLocal() as session:
+        sd = session.execute(
+            sa.select(StorageDevice).where(StorageDevice.id == sd_id)
+        ).scalar_one_or_none()
+        yield 0, None, 1, TaskStatus.RUNNING
+        if not sd.connected:
+            logger.info("Not benchmarking {} as it's not connected".format(sd.name))
+            yield None, None, None, TaskStatus.FAILED
+            return
+        if not run_benchmark(session, sd):
+            yield None, None, None, TaskStatus.FAILED
+            return
+        yield 1, None, None, TaskStatus.SUCCESS
+
+
+def claim_fanout_tasks(session, file):
+    """Claim the pending transfers of the same file to other connected
+    devices that have a free transfer slot and return them as
+    [(task id, File)]. The slots are given back by release_fanout_slots."""
+    rows = session.execute(
+        sa.select(Task.id, File)
+        .join(File, File.id == sa.func.json_extract(Task.args, "$[0]"))
+        .where(
+            Task.func == "transfer_file",
+            Task.status == TaskStatus.PENDING,
+            File.remote_path == file.remote_path,
+            File.storage_device_id != file.storage_device_id,
+        )
+        .order_by(Task.id)
+    ).all()
+    claimed = []
+    for task_id, target in rows:
+        if len(claimed) >= MAX_FANOUT_TARGETS:
+            break
+        if not target.storage_device.connected:
+            continue
+        device = target.storage_device_id
+        if scheduler is not None and not scheduler.acquire(device):
+            continue
+        if claim_task(session, task_id):
+            claimed.append((task_id, target))
+        elif scheduler is not None:
+            scheduler.release(device)
+    return claimed
+
+
+def release_fanout_slots(devices):
+    if scheduler is None:
+        return
+    for device in devices:
+        scheduler.release(device)
+
+
+def forget_partial(sd_id, storage_path):
+    # the partial file and checkpoint of a finished transfer are gone
+    for path in (get_partial_path(storage_path), get_checkpoint_path(storage_path)):
+        manifest_cache.removed(sd_id, path)
+
+
+def finish_fanout_target(target, stat, total, hasher):
+    # a finished copy is put in place, anything else keeps its partial file
+    # and a checkpoint to resume from
+    fd = target["fd"]
+    storage_path = target["storage_path"]
+    if target["outcome"] == "done":
+        os.ftruncate(fd, total)
+        os.fsync(fd)
+        if CACHE_MODE != "buffered":
+            drop_cache(fd, target["dropped"], total)
+        os.close(fd)
+        target["fd"] = None
+        target["file"].checksum = hasher.hexdigest()
+        os.replace(get_partial_path(storage_path), storage_path)
+        remove_checkpoint(storage_path)
+        forget_partial(target["sd_id"], storage_path)
+        manifest_cache.written(target["sd_id"], storage_path)
+    elif target["outcome"] == "detached" and target["position"]:
+        write_checkpoint(storage_path, fd, stat, target["position"])
+
+
+def fan_out(session, file, total, siblings):
+    """Copy a file to its own device and to the siblings' devices at once.
+
+    The source is read once with FanOutCopy. Progress is yielded for the
+    transfer_file running this, and each sibling's is reported to its own
+    task. A failed target only fails its own task. A detached sibling, one
+    that stalled or was stopped, is queued again to resume on its own.
+    Returns the outcome of file's own copy, "done", "failed" or "detached".
+    """
+    local_path = file.local_path
+    targets = [{"task_id": None, "file": file}] + [
+        {"task_id": task_id, "file": sibling} for task_id, sibling in siblings
+    ]
+    for target in targets:
+        target.update(
+            storage_path=target["file"].storage_path,
+            sd_id=target["file"].storage_device_id,
+            fd=None,
+            outcome=None,
+            position=0,
+            dropped=0,
+        )
+        if target["task_id"] is not None:
+            progress_registry.start(target["task_id"], total=total)
+    chunk_size = file.storage_device.chunk_size or BUFFER_SIZE
+    logger.info(
+        "Fanning out {} to {}".format(
+            local_path, ", ".join(t["file"].storage_device.name for t in targets)
+        )
+    )
+    # the copy only uses the values read above, so no transaction is held
+    session.commit()
+    file_in = None
+    hasher = None
+    copy = None
+    events = None
+    active = []
+    methods = Counter()
+    try:
+        # the staged copy when there's a current one
+        file_in, source_path = open_source(local_path, READ_FLAGS)
+        stat = os.fstat(file_in)
+        for target in targets:
+            storage_path = target["storage_path"]
+            try:
+                if not os.path.exists(os.path.dirname(storage_path)):
+                    os.makedirs(os.path.dirname(storage_path))
+                target["fd"] = os.open(
+                    get_partial_path(storage_path), WRITE_FLAGS, stat.st_mode
+                )
+                offset = get_resume_offset(storage_path, file_in, target["fd"], stat)
+                if not offset:
+                    os.ftruncate(target["fd"], 0)
+                preallocate(target["fd"], offset, total)
+            except OSError as e:
+                logger.error("Unable to transfer {}".format(storage_path))
+                logger.exception(e)
+                target["outcome"] = "failed"
+                continue
+            step = max(math.ceil(total / 100), 1)
+            target.update(
+                position=offset,
+                step=step,
+                next_update=offset + step,
+                next_checkpoint=offset + CHECKPOINT_INTERVAL,
+                next_drop=offset + DROP_INTERVAL,
+            )
+            active.append(target)
+        if active:
+            advise(file_in, 0, 0, "POSIX_FADV_SEQUENTIAL")
+            # every target gets the same bytes so they share the checksum, the
+            # prefix they all have is read back from one of them
+            start = min(active, key=lambda target: target["position"])
+            hasher = StreamHasher(
+                file_in,
+                prefix_path=get_partial_path(start["storage_path"]),
+                prefix_end=start["position"],
+            )
+            hasher.update_to(start["position"])
+            devices = [target["sd_id"] for target in active]
+            copy = FanOutCopy(
+                file_in,
+                [(target["fd"], target["position"]) for target in active],
+                total,
+                chunk_size,
+                throttle_source=lambda amount: bandwidth_limiter.throttle_source(
+                    source_path, amount
+                ),
+                throttle_target=lambda index, amount: bandwidth_limiter.throttle_device(
+                    devices[index], amount
+                ),
+            )
+            events = copy.run()
+        for index, event, value in events or []:
+            target = active[index]
+            task_id = target["task_id"]
+            if event != "progress":
+                target["outcome"] = event
+                if event == "failed":
+                    logger.error("Unable to transfer {}".format(target["storage_path"]))
+                    logger.exception(value)
+                else:
+                    target["position"] = value
+                continue
+            methods["fanout"] += value - target["position"]
+            target["position"] = value
+            hasher.update_to(value)
+            if value >= target["next_checkpoint"]:
+                target["next_checkpoint"] = value + CHECKPOINT_INTERVAL
+                write_checkpoint(target["storage_path"], target["fd"], stat, value)
+            if CACHE_MODE != "buffered" and value >= target["next_drop"]:
+                target["next_drop"] = value + DROP_INTERVAL
+                drop_cache(target["fd"], target["dropped"], value, dirty=True)
+                target["dropped"] = value
+            if task_id is not None and progress_registry.is_stopped(task_id):
+                copy.detach(index)
+            if value >= target["next_update"]:
+                target["next_update"] = value + target["step"]
+                if task_id is None:
+                    yield value, None, None, TaskStatus.RUNNING
+                else:
+                    progress_registry.update(task_id, value)
+                    if progress_registry.should_flush(task_id):
+                        flush_progress(session, task_id)
+    except Exception as e:
+        logger.error("Unable to transfer {}".format(local_path))
+        logger.exception(e)
+        for target in targets:
+            if target["outcome"] is None:
+                target["outcome"] = "failed"
+    finally:
+        if events is not None:
+            events.close()
+        for index, target in enumerate(active):
+            if target["outcome"] is None:
+                # interrupted, e.g. file's own task was stopped
+                target["outcome"] = "detached"
+                target["position"] = copy.targets[index].position
+        for target in targets:
+            try:
+                if target["fd"] is not None:
+                    finish_fanout_target(target, stat, total, hasher)
+            except Exception as e:
+                logger.error("Unable to finish {}".format(target["storage_path"]))
+                logger.exception(e)
+                target["outcome"] = "failed"
+            if target["fd"] is not None:
+                os.close(target["fd"])
+            if target["outcome"] == "failed":
+                target["file"].status = FileStatus.MISSING
+        if hasher is not None:
+            hasher.close()
+        if file_in is not None:
+            os.close(file_in)
+        record_copy_methods(methods)
+        session.commit()
+        for target in targets[1:]:
+            task_id = target["task_id"]
+            if target["outcome"] == "done":
+                progress_registry.update(task_id, total, status=TaskStatus.SUCCESS)
+            elif target["outcome"] == "failed":
+                progress_registry.update(task_id, 0, status=TaskStatus.FAILED)
+            elif not progress_registry.is_stopped(task_id):
+                progress_registry.update(task_id, status=TaskStatus.PENDING)
+            flush_progress(session, task_id)
+            progress_registry.remove(task_id)
+            if target["outcome"] == "detached" and not shutdown_event.is_set():
+                # the caller's session, the scoped one would close it on exit
+                status = session.execute(
+                    sa.select(Task.status).where(Task.id == task_id)
+                ).scalar_one()
+                if status == TaskStatus.PENDING:
+                    add_task_to_queue(task_id, PRIORITY_BACKGROUND)
+    return targets[0]["outcome"]
+
+
 def transfer_file(file_id):
     with database.SessionLocal() as session:
         file = session.execute(
@@ -292,27 +1218,146 @@ def transfer_file(file_id):
         ).scalar_one_or_none()
         local_path = file.local_path
         storage_path = file.storage_path
+        sd = file.storage_device
+        sd_id = sd.id
+        chunk_size = sd.chunk_size or BUFFER_SIZE
         if not os.path.exists(os.path.dirname(storage_path)):
             os.makedirs(os.path.dirname(storage_path))
         total = os.path.getsize(local_path)
         yield None, None, total, TaskStatus.RUNNING
         session.commit()
+        siblings = claim_fanout_tasks(session, file)
+        if siblings:
+            devices = [sibling.storage_device_id for _, sibling in siblings]
+            try:
+                outcome = yield from fan_out(session, file, total, siblings)
+            finally:
+                release_fanout_slots(devices)
+            if outcome == "done":
+                logger.info("Finished syncing {}".format(local_path))
+                yield total, None, None, TaskStatus.SUCCESS
+                return
+            if outcome == "failed":
+                yield 0, None, None, TaskStatus.FAILED
+                return
+            # carries on alone from where the fan-out got to
+        # nothing is read from the session again until the copy is done, so
+        # it doesn't hold a transaction open for all of it
+        session.commit()
+        file_in = None
+        file_out = None
+        hasher = None
         try:
-            file_in = os.open(local_path, READ_FLAGS)
+            # the staged copy when there's a current one
+            file_in, source_path = open_source(local_path, READ_FLAGS)
+            if source_path != local_path:
+                logger.info("Transferring {} from staging".format(local_path))
             stat = os.fstat(file_in)
-            file_out = os.open(storage_path, WRITE_FLAGS, stat.st_mode)
-            for i, x in enumerate(iter(lambda: os.read(file_in, BUFFER_SIZE), b"")):
-                os.write(file_out, x)
-                # for every 1% update the transfer
-                if i % math.ceil(total / 100 / BUFFER_SIZE) == 0:
-                    progress = os.lseek(file_in, 0, os.SEEK_CUR)
+            partial_path = get_partial_path(storage_path)
+            file_out = os.open(partial_path, WRITE_FLAGS, stat.st_mode)
+            offset = get_resume_offset(storage_path, file_in, file_out, stat)
+            if offset:
+                logger.info(
+                    "Resuming {} from {:0.2%}".format(local_path, offset / total)
+                )
+                yield offset, None, None, TaskStatus.RUNNING
+            else:
+                os.ftruncate(file_out, 0)
+            preallocate(file_out, offset, total)
+            advise(file_in, 0, 0, "POSIX_FADV_SEQUENTIAL")
+            page_cache = get_page_cache()
+            # hashes the source as it's copied, a resumed prefix is read back
+            # from the device rather than the slower source
+            hasher = StreamHasher(file_in, prefix_path=partial_path, prefix_end=offset)
+            hasher.update_to(offset)
+            # for every 1% update the transfer
+            step = max(math.ceil(total / 100), 1)
+            next_update = offset + step
+            next_checkpoint = offset + CHECKPOINT_INTERVAL
+            next_drop = offset + DROP_INTERVAL
+            # how far the page cache has been dropped behind the copy
+            dropped_in = dropped_out = 0
+            copied = offset
+            # time spent waiting for the bandwidth limits isn't the device's
+            started = monotonic()
+            throttled = 0
+            load = scheduler.get_load(sd_id) if scheduler is not None else None
+            methods = Counter()
+            for progress, method in copy_fd(
+                file_in,
+                file_out,
+                offset,
+                total,
+                chunk_size,
+                direct=CACHE_MODE == "direct",
+            ):
+                methods[method] += progress - copied
+                hasher.update_to(progress)
+                delay = bandwidth_limiter.throttle(
+                    sd_id, source_path, progress - copied
+                )
+                copied = progress
+                if delay:
+                    shutdown_event.wait(delay)
+                    throttled += delay
+                if progress >= next_checkpoint:
+                    next_checkpoint = progress + CHECKPOINT_INTERVAL
+                    write_checkpoint(storage_path, file_out, stat, progress)
+                if CACHE_MODE != "buffered" and progress >= next_drop:
+                    next_drop = progress + DROP_INTERVAL
+                    drop_cache(file_out, dropped_out, progress, dirty=True)
+                    dropped_out = progress
+                    # the hasher reads the source back, only drop what it's done
+                    hashed = hasher.position
+                    drop_cache(file_in, dropped_in, hashed)
+                    dropped_in = hashed
+                if progress >= next_update:
+                    next_update = progress + step
                     logger.info(
-                        "{file} {progress:0.2%}.{i}".format(
-                            file=local_path, progress=progress / total, i=i
+                        "{file} {progress:0.2%} ({method})".format(
+                            file=local_path, progress=progress / total, method=method
                         )
                     )
                     yield progress, None, None, TaskStatus.RUNNING
-            logger.info("Finished transferring {}".format(local_path))
+            os.ftruncate(file_out, total)
+            os.fsync(file_out)
+            if CACHE_MODE != "buffered":
+                drop_cache(file_out, dropped_out, total)
+            os.close(file_out)
+            file_out = None
+            elapsed = monotonic() - started
+            # transfers running on the device on average while this one did
+            concurrent = (
+                (scheduler.get_load(sd_id) - load) / elapsed
+                if load is not None and elapsed > 0
+                else 1
+            )
+            apply_tuning(
+                sd,
+                device_tuner.observe(
+                    sd, total - offset, elapsed - throttled, concurrent
+                ),
+            )
+            file.checksum = hasher.hexdigest()
+            if CACHE_MODE != "buffered":
+                drop_cache(file_in, dropped_in, total)
+            after = get_page_cache()
+            if page_cache is not None and after is not None:
+                logger.info(
+                    "Page cache changed by {:+d} bytes, {} bytes dirty".format(
+                        after["cached"] - page_cache["cached"], after["dirty"]
+                    )
+                )
+            os.replace(partial_path, storage_path)
+            remove_checkpoint(storage_path)
+            forget_partial(sd_id, storage_path)
+            manifest_cache.written(sd_id, storage_path)
+            record_copy_methods(methods)
+            logger.info(
+                "Finished transferring {} using {}".format(
+                    local_path, ", ".join(methods) or "nothing"
+                )
+            )
             yield total, None, None, TaskStatus.SUCCESS
             session.commit()
             logger.info("Finished syncing {}".format(local_path))
@@ -323,16 +1368,16 @@ def transfer_file(file_id):
             session.commit()
             yield 0, None, None, TaskStatus.FAILED
         finally:
-            try:
-                os.close(file_in)
-            except Exception as e:
-                logger.error("Unable to close file_in")
-                logger.exception(e)
-            try:
-                os.close(file_out)
-            except Exception as e:
-                logger.error("Unable to close file_out")
-                logger.exception(e)
+            if hasher is not None:
+                hasher.close()
+            for fd, name in ((file_in, "file_in"), (file_out, "file_out")):
+                if fd is None:
+                    continue
+                try:
+                    os.close(fd)
+                except Exception as e:
+                    logger.error("Unable to close {}".format(name))
+                    logger.exception(e)
 
 
 def eject_sd(sd_id):
@@ -342,26 +1387,36 @@ def eject_sd(sd_id):
             sa.select(StorageDevice).where(StorageDevice.id == sd_id)
         ).scalar_one_or_none()
         sd.eject()
+        manifest_cache.invalidate(sd.id)
         session.commit()
         yield 1, 1, TaskStatus.SUCCESS
 
 
+def apply_eviction(session, sd, eviction):
+    """Delete the files chosen by eviction.plan_eviction from a storage device.
+
+    Rows are marked missing a batch at a time and empty folders are cleaned
+    up once at the end.
+    """
+    if not eviction["evicted"]:
+        return
+    manifest = manifest_cache.get(sd)
+    removed = []
+    for entry in eviction["evicted"]:
+        logger.info("Evicting '{}' from {}".format(entry["title"], sd.name))
+        manifest.discard(sd.get_drive_path(entry["remote_path"]))
+        # watched files stay watched so they aren't copied again
+        if entry["status"] != FileStatus.WATCHED:
+            removed.append(entry["id"])
+        if len(removed) >= FILE_BATCH_SIZE:
+            upsert_files(session, [], removed)
+    upsert_files(session, [], removed)
+    remove_empty_folders(sd.base_path)
+
+
 def transfer_files(sd_id):
-    with database.SessionLocal() as session:
-        sd = session.execute(
-            sa.select(StorageDevice).where(StorageDevice.id == sd_id)
-        ).scalar_one_or_none()
-        files = (
-            session.execute(
-                sa.select(File).where(
-                    File.storage_device_id == sd.id, File.status == FileStatus.MISSING
-                )
-            )
-            .scalars()
-            .all()
-        )
-        file_ids = [file.id for file in files]
-        return transfer_some_files(sd_id, file_ids)
+    # the planner picks the missing files that fit
+    return transfer_some_files(sd_id, None)
 
 
 def transfer_some_files(sd_id, file_ids):
@@ -369,33 +1424,63 @@ def transfer_some_files(sd_id, file_ids):
         sd = session.execute(
             sa.select(StorageDevice).where(StorageDevice.id == sd_id)
         ).scalar_one_or_none()
-        files = (
-            session.execute(sa.select(File).where(File.id.in_(file_ids)))
-            .scalars()
-            .all()
-        )
-        yield 0, None, len(files), TaskStatus.RUNNING
-        for file in files:
-            if not os.path.exists(file.local_path):
+        if sd is None:
+            logger.error("Unable to transfer files to missing device {}".format(sd_id))
+            yield None, None, None, TaskStatus.FAILED
+            return
+        if not sd.connected:
+            # its free space can't be checked, the next scheduled run catches up
+            logger.info("Not transferring to {} as it's not connected".format(sd.name))
+            yield 0, 0, 0, TaskStatus.SUCCESS
+            return
+        if sd.benchmarked_at is None:
+            # first time it's been seen connected
+            run_benchmark(session, sd)
+        plan = plan_transfers(session, sd, file_ids)
+        if plan["deferred"] and sd.eviction_policy:
+            eviction = plan_eviction(session, sd, plan)
+            apply_eviction(session, sd, eviction)
+            plan["admitted"] = sorted(
+                plan["admitted"] + eviction["admitted"],
+                key=lambda entry: (entry["rank"] is None, entry["rank"] or 0),
+            )
+            admitted = {entry["id"] for entry in eviction["admitted"]}
+            plan["deferred"] = [
+                entry for entry in plan["deferred"] if entry["id"] not in admitted
+            ]
+        session.commit()
+        yield 0, None, len(plan["admitted"]) + len(plan["synced"]), TaskStatus.RUNNING
+        if plan["synced"]:
+            session.execute(
+                sa.update(File)
+                .where(File.id.in_(plan["synced"]))
+                .values(status=FileStatus.SYNCED)
+            )
+            session.commit()
+            yield None, len(plan["synced"]), None, TaskStatus.RUNNING
+        # queued in rank order so the most wanted files are copied first
+        for entry in plan["admitted"]:
+            local_path = get_local_path(entry["remote_path"])
+            if not os.path.exists(local_path):
                 logger.error(
-                    "Unable to sync {} as it can't be found".format(file.local_path)
+                    "Unable to sync {} as it can't be found".format(local_path)
                 )
-            if (not os.path.exists(file.storage_path)) or (
-                file.file_size != os.path.getsize(file.storage_path)
-            ):
-                task = Task(
-                    name="Transfer {} to {}".format(file.title, sd.name),
-                    func="transfer_file",
-                    args=[file.id],
-                    kwargs={},
-                    total=file.file_size,
-                )
-                session.add(task)
+            task = Task(
+                name="Transfer {} to {}".format(entry["title"], sd.name),
+                func="transfer_file",
+                args=[entry["id"]],
+                kwargs={},
+                total=entry["file_size"],
+                storage_device_id=sd.id,
+            )
+            session.add(task)
 
-                session.commit()
-                add_task_to_queue(task.id)
-            else:
-                file.status = FileStatus.SYNCED
-                session.commit()
+            session.commit()
+            publish_created(task)
+            add_task_to_queue(task.id, PRIORITY_BACKGROUND)
             yield None, 1, None, TaskStatus.RUNNING
+        for entry in plan["deferred"]:
+            logger.warning(
+                "Deferring {} as it doesn't fit on {}".format(entry["title"], sd.name)
+            )
         yield None, None, None, TaskStatus.SUCCESS
@@ -0,0 +1,246 @@
+"""PlexListener against a fake Plex notification websocket.
+
+Run from backend/ with python -m unittest discover tests
+"""
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from time import monotonic, sleep
+
+scratch = tempfile.mkdtemp()
+os.environ["DATABASE_PATH"] = scratch + "/"
+os.environ["LOCAL_BASE_PATH"] = scratch + "/"
+
+import database  # noqa: E402
+import listener  # noqa: E402
+import sqlalchemy as sa  # noqa: E402
+from models import File, StorageDevice, Task  # noqa: E402
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def timeline(*rating_keys, kind=4):
+    return {
+        "NotificationContainer": {
+            "type": "timeline",
+            "TimelineEntry": [
+                {
+                    "identifier": listener.LIBRARY_IDENTIFIER,
+                    "state": listener.STATE_PROCESSED,
+                    "type": kind,
+                    "itemID": str(rating_key),
+                }
+                for rating_key in rating_keys
+            ],
+        }
+    }
+
+
+class FakePlexServer:
+    """A websocket server sending each connection its list of notifications.
+
+    connections is a list of lists of messages, one per connection in turn.
+    Each connection is closed once its messages are sent, except the last
+    one, which is held open until the server is stopped.
+    """
+
+    def __init__(self, connections, interval=0.05):
+        self.connections = list(connections)
+        self.interval = interval
+        self.accepted = 0
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.url = "ws://127.0.0.1:{}/".format(self.sock.getsockname()[1])
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            with conn:
+                self.handshake(conn)
+                for message in self.connections.pop(0):
+                    self.send(conn, json.dumps(message))
+                    sleep(self.interval)
+                if not self.connections:
+                    self.stopped.wait()
+                    return
+
+    def handshake(self, conn):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        key = next(
+            line.split(":", 1)[1].strip()
+            for line in request.decode().split("\r\n")
+            if line.lower().startswith("sec-websocket-key:")
+        )
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        conn.sendall(
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: {}\r\n\r\n".format(accept).encode()
+        )
+
+    def send(self, conn, text):
+        data = text.encode()
+        if len(data) < 126:
+            header = bytes([0x81, len(data)])
+        else:
+            header = bytes([0x81, 126]) + len(data).to_bytes(2, "big")
+        conn.sendall(header + data)
+
+    def stop(self):
+        self.stopped.set()
+        self.sock.close()
+
+
+class PlexListenerUnderTest(listener.PlexListener):
+    # flush_loop only wakes up once a second at most, often enough for tests
+    def flush_loop(self):
+        while not self.stop_event.wait(0.05):
+            self.flush()
+
+
+class PlexListenerTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff = listener.LISTENER_BACKOFF_MIN
+        listener.LISTENER_BACKOFF_MIN = 0.05
+        self.changes = []
+        self.server = None
+        self.listener = None
+
+    def tearDown(self):
+        listener.LISTENER_BACKOFF_MIN = self.backoff
+        if self.listener is not None:
+            self.listener.stop()
+        if self.server is not None:
+            self.server.stop()
+
+    def start(self, connections, debounce=0.3, max_delay=5):
+        self.server = FakePlexServer(connections)
+        self.listener = PlexListenerUnderTest(
+            url=self.server.url,
+            debounce=debounce,
+            max_delay=max_delay,
+            on_changes=lambda *change: self.changes.append(change),
+        )
+        threading.Thread(target=self.listener.run, daemon=True).start()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = monotonic() + timeout
+        while not condition():
+            if monotonic() > deadline:
+                self.fail("Timed out, changes were {}".format(self.changes))
+            sleep(0.02)
+
+    def test_debounces_a_burst_into_one_batch(self):
+        self.start([[timeline(1), timeline(2, 3), timeline(3)]])
+        self.wait_for(lambda: self.changes)
+        sleep(0.5)
+        self.assertEqual(self.changes, [({1, 2, 3}, False, False)])
+
+    def test_max_delay_flushes_a_steady_stream(self):
+        self.start([[timeline(i) for i in range(40)]], debounce=0.3, max_delay=0.5)
+        self.wait_for(lambda: len(self.changes) >= 2)
+        self.assertFalse(self.changes[0][0] & self.changes[1][0])
+
+    def test_playlist_and_played_notifications(self):
+        stopped = {
+            "NotificationContainer": {
+                "type": "playing",
+                "PlaySessionStateNotification": [
+                    {"state": "stopped", "ratingKey": "7"}
+                ],
+            }
+        }
+        self.start([[timeline(5, kind=listener.PLAYLIST_TYPE), stopped]])
+        self.wait_for(lambda: self.changes)
+        self.assertEqual(self.changes, [({7}, True, False)])
+
+    def test_reconnects_and_resyncs_what_was_missed(self):
+        self.start([[timeline(1)], []])
+        self.wait_for(lambda: any(missed for _, _, missed in self.changes))
+        self.assertGreaterEqual(self.server.accepted, 2)
+        self.assertIn(1, set().union(*(keys for keys, _, _ in self.changes)))
+
+
+class QueueChangesTest(unittest.TestCase):
+    def setUp(self):
+        database.Base.metadata.create_all(bind=database.engine)
+        self.session = database.SessionLocal()
+        self.devices = []
+        for name, sync_all_episodes in (("a", True), ("b", False), ("c", True)):
+            base_path = os.path.join(scratch, name) + "/"
+            os.makedirs(base_path, exist_ok=True)
+            sd = StorageDevice(
+                name=name, base_path=base_path, sync_all_episodes=sync_all_episodes
+            )
+            self.session.add(sd)
+            self.session.flush()
+            self.devices.append(sd.id)
+        # a holds 1 and 2, b holds 2, c holds nothing
+        for sd_id, rating_key in ((self.devices[0], 1), (self.devices[0], 2)):
+            self.add_file(sd_id, rating_key)
+        self.add_file(self.devices[1], 2)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        database.SessionLocal.remove()
+        database.Base.metadata.drop_all(bind=database.engine)
+
+    def add_file(self, sd_id, rating_key):
+        self.session.add(
+            File(
+                storage_device_id=sd_id,
+                title="File {}".format(rating_key),
+                remote_path="/media/{}.mkv".format(rating_key),
+                rating_key=rating_key,
+                file_size=1,
+            )
+        )
+
+    def get_queued(self):
+        with database.SessionLocal() as session:
+            return {
+                task.storage_device_id: task.args[1]
+                for task in session.execute(
+                    sa.select(Task).where(Task.func == "sync_items")
+                ).scalars()
+            }
+
+    def test_only_devices_holding_a_change_sync_it(self):
+        listener.queue_changes({2, 99})
+        # 99 is on no device, it may be a new episode for a and c
+        self.assertEqual(
+            self.get_queued(),
+            {
+                self.devices[0]: [2, 99],
+                self.devices[1]: [2],
+                self.devices[2]: [99],
+            },
+        )
+
+    def test_nothing_queued_for_devices_without_the_items(self):
+        listener.queue_changes({1})
+        self.assertEqual(self.get_queued(), {self.devices[0]: [1]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+from datetime import datetime, time
+from time import monotonic
+
+import yaml
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+BANDWIDTH_FILE = os.environ.get("BANDWIDTH_FILE", "bandwidth.yml")
+# seconds of unused bandwidth a bucket can save up for a burst
+BURST_SECONDS = 1.0
+
+EMPTY_CONFIG = {"limit": None, "sources": {}, "devices": {}, "schedule": []}
+
+
+class TokenBucket:
+    """Bytes per second limit shared by every transfer drawing from it.
+
+    consume takes the bytes just copied and returns how long to wait before
+    copying more. The bucket can go into debt so a chunk bigger than the
+    burst only has to be paid for afterwards. A rate of None is unlimited.
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        if self.rate:
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate,
+                self.rate * BURST_SECONDS,
+            )
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self._refill()
+                self.rate = rate
+                self.tokens = 0.0
+
+    def consume(self, amount):
+        with self.lock:
+            self._refill()
+            if not self.rate:
+                return 0.0
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0.0)
+
+
+def parse_time(value):
+    if isinstance(value, time):
+        return value
+    if isinstance(value, int):
+        # yaml reads an unquoted 18:00 as minutes
+        return time(*divmod(value, 60))
+    return time.fromisoformat(value)
+
+
+def in_window(start, end, now):
+    if start <= end:
+        return start <= now < end
+    # the window runs past midnight
+    return now >= start or now < end
+
+
+class BandwidthLimiter:
+    """Global, per source and per storage device transfer limits.
+
+    The config is {"limit", "sources", "devices", "schedule"}, limits are in
+    bytes per second and None is unlimited. Sources are matched by the
+    longest path prefix of the file being read. A schedule entry of
+    {"start": "18:00", "end": "23:00", "limit": ...} replaces the global limit
+    during that time of day. The config is kept in BANDWIDTH_FILE.
+    """
+
+    def __init__(self, path=BANDWIDTH_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket()
+        self.source_buckets = {}
+        self.device_buckets = {}
+        self.config = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict(EMPTY_CONFIG)
+        try:
+            with open(self.path, "r") as f:
+                config = yaml.load(f, Loader=yaml.FullLoader) or {}
+            return self.validate(config)
+        except (ValueError, TypeError, yaml.YAMLError) as e:
+            logger.error("Ignoring invalid {}: {}".format(self.path, e))
+            return dict(EMPTY_CONFIG)
+
+    def validate(self, config):
+        return {
+            "limit": config.get("limit"),
+            "sources": dict(config.get("sources") or {}),
+            "devices": {
+                int(device): limit
+                for device, limit in (config.get("devices") or {}).items()
+            },
+            "schedule": [
+                {
+                    "start": parse_time(entry["start"]),
+                    "end": parse_time(entry["end"]),
+                    "limit": entry.get("limit"),
+                }
+                for entry in config.get("schedule") or []
+            ],
+        }
+
+    def get_config(self):
+        with self.lock:
+            return {
+                "limit": self.config["limit"],
+                "sources": dict(self.config["sources"]),
+                "devices": dict(self.config["devices"]),
+                "schedule": [dict(entry) for entry in self.config["schedule"]],
+            }
+
+    def set_config(self, config):
+        config = self.validate(config)
+        with self.lock:
+            self.config = config
+        with open(self.path, "w") as f:
+            yaml.dump(
+                {
+                    **config,
+                    "schedule": [
+                        {
+                            "start": entry["start"].isoformat("minutes"),
+                            "end": entry["end"].isoformat("minutes"),
+                            "limit": entry["limit"],
+                        }
+                        for entry in config["schedule"]
+                    ],
+                },
+                f,
+            )
+        logger.info("Bandwidth limits changed to {}".format(config))
+        return self.get_config()
+
+    def get_global_limit(self, now=None):
+        now = (now or datetime.now()).time()
+        with self.lock:
+            for entry in self.config["schedule"]:
+                if in_window(entry["start"], entry["end"], now):
+                    return entry["limit"]
+            return self.config["limit"]
+
+    def get_source(self, path):
+        with self.lock:
+            matches = [
+                source for source in self.config["sources"] if path.startswith(source)
+            ]
+        return max(matches, key=len) if matches else None
+
+    def get_bucket(self, buckets, key, limit):
+        with self.lock:
+            bucket = buckets.setdefault(key, TokenBucket())
+        bucket.set_rate(limit)
+        return bucket
+
+    def throttle_source(self, path, amount):
+        """Account for amount bytes read from path against the global and
+        source limits, return how many seconds to wait before reading more."""
+        self.global_bucket.set_rate(self.get_global_limit())
+        buckets = [self.global_bucket]
+        source = self.get_source(path)
+        if source is not None:
+            with self.lock:
+                limit = self.config["sources"].get(source)
+            buckets.append(self.get_bucket(self.source_buckets, source, limit))
+        return max(bucket.consume(amount) for bucket in buckets)
+
+    def throttle_device(self, device_id, amount):
+        """Account for amount bytes written to a storage device, return how
+        many seconds to wait before writing more."""
+        with self.lock:
+            limit = self.config["devices"].get(device_id)
+        return self.get_bucket(self.device_buckets, device_id, limit).consume(amount)
+
+    def throttle(self, device_id, path, amount):
+        """Account for amount bytes copied from path to a storage device and
+        return how many seconds to wait before copying more."""
+        return max(
+            self.throttle_source(path, amount),
+            self.throttle_device(device_id, amount),
+        )
+
+
+bandwidth_limiter = BandwidthLimiter()
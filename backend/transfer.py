@@ -0,0 +1,721 @@
+import errno
+import hashlib
+import json
+import logging
+import mmap
+import os
+import queue
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    import ctypes.util
+
+    # fallocate(2) itself, posix_fallocate falls back to writing zeros to
+    # every block on filesystems without it, like the exFAT and FAT most USB
+    # drives use
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # fallocate64 takes a 64 bit off_t on 32 bit systems too
+    _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, TypeError, AttributeError):
+    _fallocate = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.DEBUG)
+log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+stream_handler.setFormatter(logging.Formatter(log_format))
+logger.addHandler(stream_handler)
+
+BUFFER_SIZE = 1024 * 1024 * 10  # 10MB
+CHECKPOINT_INTERVAL = 1024 * 1024 * 256  # 256MB
+VERIFY_SIZE = 1024 * 1024  # 1MB
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB
+# buffers of BUFFER_SIZE shared by the reader and writer of a pipelined copy
+PIPELINE_BUFFERS = int(os.environ.get("PIPELINE_BUFFERS", 2))
+# buffers shared by all the targets of a fan-out copy, and the seconds the
+# reader waits for the slowest target to free one before detaching it
+FANOUT_BUFFERS = int(os.environ.get("FANOUT_BUFFERS", 4))
+FANOUT_STALL = float(os.environ.get("FANOUT_STALL", 30))
+# how transfers use the page cache: "buffered" leaves it to the kernel,
+# "dontneed" drops what's been copied every DROP_INTERVAL so a big transfer
+# doesn't evict everything else and "direct" also writes pipelined copies
+# with O_DIRECT
+CACHE_MODE = os.environ.get("TRANSFER_CACHE_MODE", "dontneed")
+DROP_INTERVAL = 1024 * 1024 * 64  # 64MB
+# O_DIRECT offsets, lengths and buffers are multiples of this
+DIRECT_ALIGNMENT = 4096
+
+PARTIAL_SUFFIX = ".partial"
+CHECKPOINT_SUFFIX = ".partial.json"
+
+# errors raised when a copy method can't handle this pair of files (different
+# filesystems, unsupported filesystem, not a socket, ...) rather than a real
+# I/O failure, these cause the engine to fall back to the next method
+UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+
+def _copy_file_range(file_in, file_out, offset, count):
+    return os.copy_file_range(file_in, file_out, count, offset, offset)
+
+
+def _sendfile(file_in, file_out, offset, count):
+    # sendfile writes at the current position of file_out
+    os.lseek(file_out, offset, os.SEEK_SET)
+    return os.sendfile(file_out, file_in, offset, count)
+
+
+def _read_write(file_in, file_out, offset, count):
+    data = os.pread(file_in, count, offset)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(file_out, data[written:], offset + written)
+    return len(data)
+
+
+# copy methods in order of preference
+COPY_METHODS = {}
+if hasattr(os, "copy_file_range"):
+    COPY_METHODS["copy_file_range"] = _copy_file_range
+if hasattr(os, "sendfile"):
+    COPY_METHODS["sendfile"] = _sendfile
+COPY_METHODS["read_write"] = _read_write
+
+
+def _read_into(file_in, view, offset):
+    """Fill view with the bytes of file_in from offset."""
+    position = 0
+    while position < len(view):
+        if hasattr(os, "preadv"):
+            count = os.preadv(file_in, [view[position:]], offset + position)
+        else:
+            os.lseek(file_in, offset + position, os.SEEK_SET)
+            count = os.readv(file_in, [view[position:]])
+        if count == 0:
+            raise OSError(
+                errno.EIO, "Unexpected end of file at {}".format(offset + position)
+            )
+        position += count
+
+
+def _write_from(file_out, view, offset):
+    position = 0
+    while position < len(view):
+        position += os.pwrite(file_out, view[position:], offset + position)
+
+
+def advise(fd, offset, length, advice):
+    """posix_fadvise where it's available, the advice is only a hint."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError as e:
+        logger.debug("Unable to advise {} ({})".format(advice, e))
+
+
+def drop_cache(fd, start, end, dirty=False):
+    """Evict the bytes from start to end of fd from the page cache.
+
+    Dirty pages aren't dropped until they're written, so a file being
+    written is synced first.
+    """
+    if end <= start:
+        return
+    if dirty:
+        os.fdatasync(fd)
+    advise(fd, start, end - start, "POSIX_FADV_DONTNEED")
+
+
+def preallocate(fd, offset, total):
+    """Reserve the blocks for the rest of the file up front, so a device
+    that's too full fails straight away and the file isn't fragmented.
+    Skipped where the filesystem can't do it without writing the blocks."""
+    if total <= offset or _fallocate is None:
+        return
+    if _fallocate(fd, 0, offset, total - offset) != 0:
+        code = ctypes.get_errno()
+        if code not in UNSUPPORTED_ERRNOS:
+            raise OSError(code, os.strerror(code))
+        logger.debug("Unable to preallocate ({})".format(os.strerror(code)))
+
+
+def get_page_cache():
+    """Return the page cache sizes in bytes from /proc/meminfo, or None."""
+    fields = {"Cached": "cached", "Dirty": "dirty", "Writeback": "writeback"}
+    try:
+        with open("/proc/meminfo", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    cache = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in fields:
+            # reported in kB
+            cache[fields[name]] = int(value.split()[0]) * 1024
+    return cache if len(cache) == len(fields) else None
+
+
+def set_direct(fd, enabled):
+    """Turn O_DIRECT on or off for fd, returning whether it could be set."""
+    if fcntl is None or not hasattr(os, "O_DIRECT"):
+        return False
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    flags = flags | os.O_DIRECT if enabled else flags & ~os.O_DIRECT
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    except OSError as e:
+        logger.debug("Unable to set O_DIRECT ({})".format(e))
+        return False
+    return True
+
+
+def pipeline_copy(
+    file_in,
+    file_out,
+    offset,
+    total,
+    chunk_size=BUFFER_SIZE,
+    buffers=PIPELINE_BUFFERS,
+    direct=False,
+):
+    """Copy file_in to file_out with reads and writes overlapping.
+
+    A reader thread fills a ring of preallocated buffers from file_in while
+    the caller writes the ones already read to file_out, so neither device
+    waits for the other and the copy runs at the speed of the slower one.
+    With direct the writes bypass the page cache, the buffers are page
+    aligned and the last one is padded, the caller truncates the file to
+    total afterwards. Yields the position after every chunk, like copy_fd.
+    """
+    direct = (
+        direct
+        and offset % DIRECT_ALIGNMENT == 0
+        and chunk_size % DIRECT_ALIGNMENT == 0
+        and set_direct(file_out, True)
+    )
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _ in range(max(buffers, 2)):
+        # anonymous mmaps are page aligned
+        free.put(
+            memoryview(mmap.mmap(-1, chunk_size) if direct else bytearray(chunk_size))
+        )
+    stopped = threading.Event()
+
+    def read():
+        position = offset
+        try:
+            while position < total and not stopped.is_set():
+                buffer = free.get()
+                if buffer is None:
+                    return
+                view = buffer[: min(chunk_size, total - position)]
+                _read_into(file_in, view, position)
+                filled.put((buffer, view, position))
+                position += len(view)
+        except Exception as e:
+            filled.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while offset < total:
+            item = filled.get()
+            if isinstance(item, Exception):
+                raise item
+            buffer, view, position = item
+            offset = position + len(view)
+            if direct:
+                padded = -(-len(view) // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+                try:
+                    _write_from(file_out, buffer[:padded], position)
+                except OSError as e:
+                    # some filesystems take O_DIRECT but not these writes
+                    if e.errno != errno.EINVAL:
+                        raise
+                    logger.debug("O_DIRECT write failed, writing buffered")
+                    set_direct(file_out, False)
+                    direct = False
+            if not direct:
+                _write_from(file_out, view, position)
+            free.put(buffer)
+            yield offset
+    finally:
+        stopped.set()
+        # wakes the reader if it's waiting for a buffer
+        free.put(None)
+        reader.join()
+        if direct:
+            set_direct(file_out, False)
+
+
+def is_cross_device(file_in, file_out):
+    return os.fstat(file_in).st_dev != os.fstat(file_out).st_dev
+
+
+def copy_fd(
+    file_in,
+    file_out,
+    offset,
+    total,
+    chunk_size=BUFFER_SIZE,
+    methods=None,
+    direct=False,
+):
+    """Copy file_in to file_out starting at offset until total bytes are written.
+
+    Tries each copy method in turn, falling back to the next one when the
+    kernel reports it can't be used for these files. Between filesystems
+    copy_file_range is still tried first, some can copy without the data
+    passing through userspace, e.g. server side on a network share. Where
+    it can't, the other kernel methods would read and then write every
+    chunk in turn so pipeline_copy is used instead unless methods are
+    given, direct is passed on to it. Yields a tuple of (position, method)
+    after every chunk.
+    """
+    if methods is None and is_cross_device(file_in, file_out):
+        kernel = not direct and "copy_file_range" in COPY_METHODS
+        while kernel and offset < total:
+            try:
+                copied = _copy_file_range(
+                    file_in, file_out, offset, min(chunk_size, total - offset)
+                )
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                logger.debug("copy_file_range unavailable ({}), pipelining".format(e))
+                break
+            if copied == 0:
+                break
+            offset += copied
+            yield offset, "copy_file_range"
+        for position in pipeline_copy(
+            file_in, file_out, offset, total, chunk_size, direct=direct
+        ):
+            yield position, "pipeline"
+        return
+    methods = list(methods or COPY_METHODS)
+    while offset < total:
+        method = methods[0]
+        try:
+            copied = COPY_METHODS[method](
+                file_in, file_out, offset, min(chunk_size, total - offset)
+            )
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS or len(methods) == 1:
+                raise
+            logger.debug("{} unavailable ({}), falling back".format(method, e))
+            methods.pop(0)
+            continue
+        if copied == 0:
+            # some filesystems report 0 bytes copied instead of an error
+            if len(methods) == 1:
+                raise OSError(errno.EIO, "Unexpected end of file at {}".format(offset))
+            logger.debug("{} copied nothing, falling back".format(method))
+            methods.pop(0)
+            continue
+        offset += copied
+        yield offset, method
+
+
+class FanOutTarget:
+    def __init__(self, fd, offset):
+        self.fd = fd
+        # written up to here, the copy starts from the lowest of these
+        self.position = offset
+        self.active = True
+        self.chunks = queue.Queue()
+        self.thread = None
+
+
+class FanOutCopy:
+    """Copy one source file to several targets, reading it only once.
+
+    A reader thread fills a ring of shared buffers and hands each chunk to
+    a writer thread per target, a buffer is reused once every target has
+    written it. Targets are (fd, offset) pairs and only get the bytes from
+    their offset, so they can resume from different places. A target that
+    fails stops on its own, one that holds up the reader for more than
+    stall seconds is detached so the others carry on. throttle_source and
+    throttle_target return seconds to wait after reading or writing bytes.
+
+    run yields (index, event, value) with the target's index:
+    ("progress", position) after each chunk written, then one of
+    ("done", position), ("detached", position) or ("failed", exception).
+    A failed read fails every target that isn't finished.
+    """
+
+    def __init__(
+        self,
+        file_in,
+        targets,
+        total,
+        chunk_size=BUFFER_SIZE,
+        buffers=FANOUT_BUFFERS,
+        stall=FANOUT_STALL,
+        throttle_source=None,
+        throttle_target=None,
+    ):
+        self.file_in = file_in
+        self.targets = [FanOutTarget(fd, offset) for fd, offset in targets]
+        self.total = total
+        self.chunk_size = chunk_size
+        self.stall = stall
+        self.throttle_source = throttle_source
+        self.throttle_target = throttle_target
+        self.lock = threading.Lock()
+        self.free = queue.Queue()
+        for _ in range(max(buffers, 2)):
+            self.free.put(memoryview(bytearray(chunk_size)))
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+
+    def _release(self, chunk):
+        # the last target to finish with a chunk returns its buffer
+        with self.lock:
+            chunk[3] -= 1
+            done = chunk[3] == 0
+        if done:
+            self.free.put(chunk[0])
+
+    def detach(self, index):
+        """Stop copying to a target, its writer reports where it got to."""
+        target = self.targets[index]
+        with self.lock:
+            if not target.active:
+                return
+            target.active = False
+        # the writer may be stuck, give back the chunks it hasn't started
+        self._drain(target)
+        target.chunks.put(None)
+
+    def _drain(self, target):
+        # nothing more is queued for a target once it isn't active
+        while True:
+            try:
+                chunk = target.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is not None:
+                self._release(chunk)
+
+    def _get_buffer(self):
+        while not self.stopped.is_set():
+            try:
+                return self.free.get(timeout=self.stall)
+            except queue.Empty:
+                pass
+            active = [i for i, t in enumerate(self.targets) if t.active]
+            if not active:
+                return None
+            slowest = min(active, key=lambda i: self.targets[i].position)
+            logger.warning("Detaching target {} as it has stalled".format(slowest))
+            self.detach(slowest)
+        return None
+
+    def _read(self):
+        position = min(target.position for target in self.targets)
+        try:
+            while position < self.total:
+                buffer = self._get_buffer()
+                if buffer is None:
+                    return
+                view = buffer[: min(self.chunk_size, self.total - position)]
+                _read_into(self.file_in, view, position)
+                end = position + len(view)
+                # queued under the lock so a chunk can't land behind the None
+                # detach leaves for a writer, where its buffer would be lost
+                with self.lock:
+                    receivers = [
+                        target
+                        for target in self.targets
+                        if target.active and target.position < end
+                    ]
+                    chunk = [buffer, view, position, len(receivers)]
+                    for target in receivers:
+                        target.chunks.put(chunk)
+                if not receivers:
+                    self.free.put(buffer)
+                position = end
+                if self.throttle_source is not None:
+                    delay = self.throttle_source(len(view))
+                    if delay:
+                        self.stopped.wait(delay)
+        except Exception as e:
+            self.events.put((None, "failed", e))
+        finally:
+            for target in self.targets:
+                target.chunks.put(None)
+
+    def _write(self, index):
+        target = self.targets[index]
+        try:
+            while True:
+                chunk = target.chunks.get()
+                if chunk is None:
+                    break
+                if not target.active:
+                    self._release(chunk)
+                    break
+                buffer, view, position, _ = chunk
+                try:
+                    skip = max(target.position - position, 0)
+                    _write_from(target.fd, view[skip:], position + skip)
+                finally:
+                    self._release(chunk)
+                written = len(view) - skip
+                target.position = position + len(view)
+                self.events.put((index, "progress", target.position))
+                if self.throttle_target is not None:
+                    delay = self.throttle_target(index, written)
+                    if delay:
+                        self.stopped.wait(delay)
+        except Exception as e:
+            with self.lock:
+                target.active = False
+            self._drain(target)
+            self.events.put((index, "failed", e))
+            return
+        if target.position >= self.total:
+            self.events.put((index, "done", target.position))
+        else:
+            self.events.put((index, "detached", target.position))
+
+    def run(self):
+        reader = threading.Thread(target=self._read, daemon=True)
+        for index, target in enumerate(self.targets):
+            target.thread = threading.Thread(
+                target=self._write, args=(index,), daemon=True
+            )
+            target.thread.start()
+        reader.start()
+        finished = set()
+        try:
+            while len(finished) < len(self.targets):
+                index, event, value = self.events.get()
+                if index is None:
+                    # the source couldn't be read, nothing more is coming
+                    for index, target in enumerate(self.targets):
+                        if index not in finished:
+                            self.detach(index)
+                            finished.add(index)
+                            yield index, "failed", value
+                    continue
+                if event != "progress":
+                    finished.add(index)
+                yield index, event, value
+        finally:
+            self.stopped.set()
+            for index in range(len(self.targets)):
+                self.detach(index)
+            # wakes the reader if it's waiting for a buffer
+            self.free.put(None)
+            reader.join()
+            for target in self.targets:
+                # a writer stuck on a dead device is left behind
+                target.thread.join(timeout=self.stall)
+
+
+def get_partial_path(storage_path):
+    return storage_path + PARTIAL_SUFFIX
+
+
+def get_checkpoint_path(storage_path):
+    return storage_path + CHECKPOINT_SUFFIX
+
+
+def write_checkpoint(storage_path, file_out, stat, offset):
+    """Durably record that the first offset bytes of the partial file are written."""
+    os.fsync(file_out)
+    checkpoint_path = get_checkpoint_path(storage_path)
+    with open(checkpoint_path + ".tmp", "w") as f:
+        json.dump(
+            {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "offset": offset}, f
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def remove_checkpoint(storage_path):
+    for path in (get_checkpoint_path(storage_path), get_partial_path(storage_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _same_bytes(file_in, file_out, offset, count):
+    return os.pread(file_in, count, offset) == os.pread(file_out, count, offset)
+
+
+def get_resume_offset(storage_path, file_in, file_out, stat):
+    """Return the offset a partial transfer can safely be resumed from.
+
+    The checkpoint is only trusted when the source hasn't changed since it was
+    written and the first and last VERIFY_SIZE bytes of the written prefix
+    still match the source, otherwise the transfer starts again from 0.
+    """
+    try:
+        with open(get_checkpoint_path(storage_path), "r") as f:
+            checkpoint = json.load(f)
+        offset = int(checkpoint["offset"])
+        if checkpoint["size"] != stat.st_size:
+            return 0
+        if checkpoint["mtime_ns"] != stat.st_mtime_ns:
+            return 0
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return 0
+    if offset <= 0 or offset > stat.st_size:
+        return 0
+    if os.fstat(file_out).st_size < offset:
+        return 0
+    count = min(VERIFY_SIZE, offset)
+    if not _same_bytes(file_in, file_out, 0, count):
+        return 0
+    if not _same_bytes(file_in, file_out, offset - count, count):
+        return 0
+    return offset
+
+
+def new_hash(name=None):
+    """Return (name, hash object) for name, or the fastest digest available."""
+    if name in (None, "xxh3_128") and xxhash is not None:
+        return "xxh3_128", xxhash.xxh3_128()
+    if name in (None, "blake3") and blake3 is not None:
+        return "blake3", blake3.blake3()
+    if name in (None, "blake2b"):
+        return "blake2b", hashlib.blake2b(digest_size=16)
+    raise ValueError("Checksum {} isn't available".format(name))
+
+
+def hash_file(path, name=None, chunk_size=HASH_CHUNK_SIZE):
+    """Return the checksum of a file in the format StreamHasher records."""
+    name, digest = new_hash(name)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return "{}:{}".format(name, digest.hexdigest())
+
+
+def verify_checksum(path, checksum):
+    """Whether a file still matches a checksum recorded by StreamHasher."""
+    return hash_file(path, checksum.split(":", 1)[0]) == checksum
+
+
+class StreamHasher:
+    """Hash a file in a background thread while it's being copied.
+
+    The copy reports how far it has got with update_to, the thread reads the
+    bytes up to there back from fd and hashes them in order. The kernel copy
+    methods never hand the data to userspace, but the ranges were just read
+    so they come from the page cache. The copy never waits for the hash,
+    only hexdigest does.
+
+    A resumed transfer's prefix, the first prefix_end bytes, is read back
+    from the partial copy at prefix_path instead of the source. Re-reading
+    it from a slow source would cost nearly a whole extra read of the file
+    before a late resume is done. The tradeoff is that the checksum then
+    describes the copy's prefix as written, which get_resume_offset only
+    spot checks against the source.
+    """
+
+    def __init__(self, fd, chunk_size=HASH_CHUNK_SIZE, prefix_path=None, prefix_end=0):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.prefix_path = prefix_path
+        self.prefix_end = prefix_end if prefix_path is not None else 0
+        self.name, self.digest = new_hash()
+        self.condition = threading.Condition()
+        self.available = 0
+        self.position = 0
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def update_to(self, position):
+        with self.condition:
+            self.available = max(self.available, position)
+            self.condition.notify()
+
+    def _run(self):
+        prefix_fd = None
+        try:
+            if self.prefix_end:
+                # a descriptor of its own, the copy's may be O_DIRECT
+                prefix_fd = os.open(self.prefix_path, os.O_RDONLY)
+            while True:
+                with self.condition:
+                    while self.position >= self.available and not (
+                        self.finished or self.closed
+                    ):
+                        self.condition.wait()
+                    if self.closed or self.position >= self.available:
+                        return
+                    count = min(self.chunk_size, self.available - self.position)
+                if self.position < self.prefix_end:
+                    count = min(count, self.prefix_end - self.position)
+                    data = os.pread(prefix_fd, count, self.position)
+                else:
+                    data = os.pread(self.fd, count, self.position)
+                if not data:
+                    raise OSError(
+                        errno.EIO, "Unexpected end of file at {}".format(self.position)
+                    )
+                self.digest.update(data)
+                self.position += len(data)
+        except Exception as e:
+            self.error = e
+        finally:
+            if prefix_fd is not None:
+                os.close(prefix_fd)
+
+    def hexdigest(self):
+        """Wait for everything passed to update_to to be hashed and return
+        the checksum as "<algorithm>:<hex digest>"."""
+        with self.condition:
+            self.finished = True
+            self.condition.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return "{}:{}".format(self.name, self.digest.hexdigest())
+
+    def close(self):
+        """Stop hashing, must be called before fd is closed."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
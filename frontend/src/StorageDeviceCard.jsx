@@ -280,6 +280,19 @@ const StorageDeviceCard = ({ storageDevice }) => {
             }}>
             Check Storage Device
           </button>
+          <button
+            className="bg-blue-500 enabled:hover:bg-blue-700 disabled:saturate-50 disabled:cursor-not-allowed text-white font-bold py-1 px-2 rounded"
+            disabled={!storageDevice.connected}
+            onClick={() => {
+              createTask({
+                name: "Verify Storage Device",
+                func: "check_files",
+                args: [storageDevice.id],
+                kwargs: { verify: true },
+              });
+            }}>
+            Verify Storage Device
+          </button>
           <button
             className="bg-blue-500 enabled:hover:bg-blue-700 text-white font-bold py-1 px-2 rounded"
             onClick={() => {
@@ -292,6 +305,18 @@ const StorageDeviceCard = ({ storageDevice }) => {
             }}>
             Sync from Plex
           </button>
+          <button
+            className="bg-blue-500 enabled:hover:bg-blue-700 text-white font-bold py-1 px-2 rounded"
+            onClick={() => {
+              createTask({
+                name: "Full Sync from Plex",
+                func: "get_files",
+                args: [storageDevice.id],
+                kwargs: { full: true },
+              });
+            }}>
+            Full Sync from Plex
+          </button>
           {files?.length -
             files?.reduce(
               (acc, file) => (file.status === "synced" ? acc + 1 : acc),
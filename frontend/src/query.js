@@ -1,5 +1,6 @@
 import { useMutation, useQuery, useQueryClient } from "@tanstack/react-query";
 import axios from "axios";
+import { useEffect } from "react";
 
 var host = window.location.protocol + "//" + window.location.hostname;
 
@@ -48,17 +49,74 @@ export const useAddServer = () => {
   });
 };
 
-export const useGetTasks = (
-  params = {
-    refetchInterval: 1000,
-    refetchIntervalInBackground: false,
-  }
-) =>
-  useQuery(
+// Follows the X-Next-Cursor header until every page has been loaded
+const getAllPages = async (url, params = {}) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const res = await gatoClient.get(url, {
+      params: { ...params, limit: 1000, ...(cursor && { cursor }) },
+    });
+    items.push(...res.data);
+    cursor = res.headers["x-next-cursor"];
+  } while (cursor);
+  return items;
+};
+
+// Keeps the tasks query up to date from the server's task event stream
+const useTaskEvents = () => {
+  const queryClient = useQueryClient();
+  useEffect(() => {
+    const source = new EventSource(
+      `${gatoClient.defaults.baseURL}/tasks/events/`
+    );
+    const update = updater => event => {
+      const data = JSON.parse(event.data);
+      queryClient.setQueryData(
+        ["tasks"],
+        tasks => tasks && updater(tasks, data)
+      );
+    };
+    const merge = update((tasks, data) =>
+      tasks.map(task => (task.id === data.id ? { ...task, ...data } : task))
+    );
+    source.addEventListener("progress", merge);
+    source.addEventListener("status", merge);
+    source.addEventListener(
+      "created",
+      update((tasks, data) =>
+        tasks.some(task => task.id === data.id) ? tasks : [...tasks, data]
+      )
+    );
+    source.addEventListener(
+      "deleted",
+      update((tasks, data) => tasks.filter(task => task.id !== data.id))
+    );
+    // the server no longer has everything since our last event
+    source.addEventListener("reset", () =>
+      queryClient.invalidateQueries(["tasks"])
+    );
+    // changes between loading the tasks and the stream opening aren't sent,
+    // reconnects resume from the last event instead
+    let opened = false;
+    source.addEventListener("open", () => {
+      if (!opened) {
+        opened = true;
+        queryClient.invalidateQueries(["tasks"]);
+      }
+    });
+    return () => source.close();
+  }, [queryClient]);
+};
+
+export const useGetTasks = (params = {}) => {
+  useTaskEvents();
+  return useQuery(
     ["tasks"],
-    () => gatoClient.get("/tasks/").then(res => res.data),
+    () => getAllPages("/tasks/"),
     params
   );
+};
 
 export const useCreateTask = () => {
   const queryClient = useQueryClient();
@@ -109,9 +167,7 @@ export const useCreateStorageDevice = () => {
 
 export const useGetFiles = storage_device_id =>
   useQuery(["files", storage_device_id], () =>
-    gatoClient
-      .get(`/storage_devices/${storage_device_id}/files/`)
-      .then(res => res.data)
+    getAllPages(`/storage_devices/${storage_device_id}/files/`)
   );
 
 export const useUpdateFile = () => {